@@ -0,0 +1,32 @@
+"""Added search indexes to influencers
+
+Revision ID: 5e1b7c2d9a04
+Revises: c693e4c8b60b
+Create Date: 2026-10-17 09:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e1b7c2d9a04'
+down_revision = 'c693e4c8b60b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_influencers_follower_count'), 'influencers', ['follower_count'], unique=False)
+    # Trigram indexes are PostgreSQL only, they back the case-insensitive substring search
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute('CREATE INDEX ix_influencers_username_trgm ON influencers USING gin (lower(username) gin_trgm_ops)')
+        op.execute('CREATE INDEX ix_influencers_bio_trgm ON influencers USING gin (lower(bio) gin_trgm_ops)')
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_influencers_bio_trgm', table_name='influencers')
+        op.drop_index('ix_influencers_username_trgm', table_name='influencers')
+    op.drop_index(op.f('ix_influencers_follower_count'), table_name='influencers')
@@ -0,0 +1,28 @@
+"""Added keyset pagination index
+
+Revision ID: 9b4d0f6e2c17
+Revises: 5e1b7c2d9a04
+Create Date: 2026-10-17 10:04:55.902117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4d0f6e2c17'
+down_revision = '5e1b7c2d9a04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The composite index serves both follower_count range filters and the
+    # (follower_count, id) ordering of search pages, so it replaces the single column one
+    op.create_index('ix_influencers_follower_count_id', 'influencers', ['follower_count', 'id'], unique=False)
+    op.drop_index(op.f('ix_influencers_follower_count'), table_name='influencers')
+
+
+def downgrade() -> None:
+    op.create_index(op.f('ix_influencers_follower_count'), 'influencers', ['follower_count'], unique=False)
+    op.drop_index('ix_influencers_follower_count_id', table_name='influencers')
@@ -0,0 +1,25 @@
+"""Added unique constraint on influencer user
+
+Revision ID: d4a8e3f1b6c2
+Revises: 9b4d0f6e2c17
+Create Date: 2026-10-17 14:21:07.540831
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8e3f1b6c2'
+down_revision = '9b4d0f6e2c17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Onboarding relies on this constraint instead of looking the user up first
+    op.create_unique_constraint('influencers_user_id_key', 'influencers', ['user_id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('influencers_user_id_key', 'influencers', type_='unique')
@@ -0,0 +1,43 @@
+"""Added change feed trigger to influencers
+
+Revision ID: e7c2a9d4f180
+Revises: d4a8e3f1b6c2
+Create Date: 2026-10-17 16:41:09.318244
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7c2a9d4f180'
+down_revision = 'd4a8e3f1b6c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_influencers_changed_at', 'influencers', [sa.text('coalesce(updated_at, created_at)')], unique=False)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    # Every inserted or updated influencer's id is sent to the listeners of the change feed
+    # (see app/changes.py) when its transaction commits
+    op.execute("""
+        CREATE OR REPLACE FUNCTION notify_influencer_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('influencer_changes', NEW.id::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER influencers_notify_change AFTER INSERT OR UPDATE ON influencers
+        FOR EACH ROW EXECUTE FUNCTION notify_influencer_change()
+    """)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP TRIGGER IF EXISTS influencers_notify_change ON influencers')
+        op.execute('DROP FUNCTION IF EXISTS notify_influencer_change()')
+    op.drop_index('ix_influencers_changed_at', table_name='influencers')
@@ -3,12 +3,19 @@ from pydantic import BaseModel
 from fastapi import Depends, HTTPException, status
 from fastapi_jwt_auth import AuthJWT, exceptions
 
-from .database import get_db, Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import get_read_db
 
 from .models import User
 
+from .cache import MemoryCache
+
 from .config import settings
 
+from .metrics import timed
+
 class JWTSettings(BaseModel):
     authjwt_token_location: set = {'cookies', 'headers'}
     authjwt_access_cookie_key: str = 'access_token'
@@ -20,21 +27,54 @@ class JWTSettings(BaseModel):
 def get_config():
     return JWTSettings()
 
-def authenticate(db: Session = Depends(get_db), Auth: AuthJWT = Depends()):
+
+class UserRegistry:
+    """
+    Ids of the users known to exist, used by the stateless auth mode. Tokens
+    are trusted once signed, the registry only confirms the user was not
+    deleted. An id is looked up in the DB the first time it is seen and then
+    trusted for the "ttl" of the cache (AUTH_REFRESH_INTERVAL), so a deleted
+    user is refused within that time. Only the ids in use are held, up to the
+    size of the cache
+    """
+
+    def __init__(self, cache: MemoryCache, enabled: bool = True):
+        self.cache = cache
+        self.enabled = enabled
+
+    def add(self, user_id: int) -> None:
+        if self.enabled:
+            self.cache.set(user_id, True)
+
+    async def exists(self, db: AsyncSession, user_id: int) -> bool:
+        """
+        Checks if a user exists, without a DB round trip when the registry knows the user
+        """
+        if self.enabled and self.cache.get(user_id):
+            return True
+        found = (await db.execute(select(User.id).filter(User.id == user_id))).scalar() is not None
+        if found:
+            self.add(user_id)
+        return found
+
+
+user_registry = UserRegistry(MemoryCache(settings.AUTH_CACHE_SIZE, settings.AUTH_REFRESH_INTERVAL), enabled = settings.AUTH_MODE == 'stateless')
+
+async def authenticate(db: AsyncSession = Depends(get_read_db), Auth: AuthJWT = Depends()):
     """
     Function to protect routes so as to enable only authenticated
     users proceed to routes
     """
     try:
-        Auth.jwt_required()
-        user_id = Auth.get_jwt_subject()
-        user = db.query(User).filter(User.id == user_id).first()
-
-
-        if not user:
-            raise Exception('User account deleted recently')
+        with timed('jwt'):
+            Auth.jwt_required()
+            user_id = int(Auth.get_jwt_subject())
     except Exception as e:
         print(e.message, e.__class__.__name__)
         # return None
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail = e.message)
+
+    # Making sure the user was not deleted since the token was issued
+    if not await user_registry.exists(db, user_id):
+        raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail = 'User account deleted recently')
     return user_id
\ No newline at end of file
@@ -0,0 +1,90 @@
+import hashlib
+import math
+
+from sqlalchemy import select
+
+from .config import settings
+from .models import User, Influencer
+
+
+class BloomFilter:
+    """
+    Bit array answering whether a string may have been added, false positives
+    happen at about "error_rate" while at most "capacity" strings were added
+    but false negatives never do. Positions of a string are derived from one
+    blake2b digest by double hashing
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size = 16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class TakenFilter:
+    """
+    Bloom filters of the emails of users and the usernames of influencers,
+    loaded at startup and updated on insert. A miss means the value is
+    certainly free so the lookup can be skipped, the unique constraints still
+    guard the insert. Until it is loaded every value may be taken
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ready = False
+        self.emails = BloomFilter(capacity, error_rate)
+        self.usernames = BloomFilter(capacity, error_rate)
+        self.skipped = 0
+
+    async def load(self, db) -> None:
+        """
+        Fills the filters with the emails and usernames in the DB, sized for twice
+        as many values as there are so inserts do not raise the error rate
+        """
+        emails = (await db.execute(select(User.email))).scalars().all()
+        usernames = (await db.execute(select(Influencer.username))).scalars().all()
+        self.emails = BloomFilter(max(self.capacity, 2 * len(emails)), self.error_rate)
+        self.usernames = BloomFilter(max(self.capacity, 2 * len(usernames)), self.error_rate)
+        for email in emails:
+            self.emails.add(email)
+        for username in usernames:
+            self.usernames.add(username)
+        self.ready = True
+
+    def add_email(self, email: str) -> None:
+        self.emails.add(email)
+
+    def add_username(self, username: str) -> None:
+        self.usernames.add(username)
+
+    def may_have_email(self, email: str) -> bool:
+        return self._may_have(self.emails, email)
+
+    def may_have_username(self, username: str) -> bool:
+        return self._may_have(self.usernames, username)
+
+    def _may_have(self, bloom: BloomFilter, value: str) -> bool:
+        if not self.ready:
+            return True
+        if value in bloom:
+            return True
+        self.skipped += 1
+        return False
+
+
+taken_filter = TakenFilter(settings.UNIQUENESS_FILTER_CAPACITY, settings.UNIQUENESS_FILTER_ERROR_RATE)
@@ -0,0 +1,118 @@
+import time
+
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from .config import settings
+
+
+class CacheBackend:
+    """
+    Interface of the storage used by the search cache, other backends
+    (e.g. a shared one) only have to implement these methods
+    """
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """
+    In-memory backend which evicts the least recently used entry once
+    "max_size" entries are stored and drops entries older than "ttl" seconds
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SearchCache:
+    """
+    Cache of search responses keyed on the normalized search parameters.
+    Keys include a generation counter which is bumped whenever an influencer
+    is onboarded so entries cached before the write are never served again
+    """
+
+    def __init__(self, backend: CacheBackend, enabled: bool = True):
+        self.backend = backend
+        self.enabled = enabled
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, keyword: Optional[str], min_followers: Optional[int], max_followers: Optional[int], *page) -> tuple:
+        """
+        Normalizes the search parameters into a cache key, parameters which
+        give the same results map to the same key
+        """
+        return (self.generation, keyword.lower() if keyword else None, min_followers or None, max_followers or None) + page
+
+    def get(self, key: tuple) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: tuple, value: Any) -> None:
+        # Results computed before an onboarding finished carry an old generation and are skipped
+        if self.enabled and key[0] == self.generation:
+            self.backend.set(key, value)
+
+    def invalidate(self) -> None:
+        """
+        Bumps the generation so every cached search is ignored, old entries age
+        out of the backend on their own
+        """
+        self.generation += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'size': len(self.backend),
+            'generation': self.generation,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+search_cache = SearchCache(MemoryCache(settings.SEARCH_CACHE_SIZE, settings.SEARCH_CACHE_TTL), enabled = settings.SEARCH_CACHE_SIZE > 0)
@@ -0,0 +1,220 @@
+"""
+Change feed of the influencers table.
+
+Every API process keeps in-memory state built from the influencers (search
+index, snapshot overlay, shards, follower summary, username index, uniqueness
+filters). The feed delivers the rows inserted or updated by any process to
+all of them in batches, so that state follows the table within milliseconds
+without being reloaded. Rows come from one of two sources:
+
+- "poll" reads the rows whose updated_at (created_at for rows never updated)
+  is past a watermark every interval. Timestamps are taken when a transaction
+  starts and a long one may commit after younger ones were read, so polls look
+  a lookback window behind the latest change and remember the rows seen in it
+  to deliver each change once.
+- "notify" listens to the channel the trigger of the migrations sends the id
+  of every inserted or updated row to, notifications arrive when the writing
+  transaction commits. Ids arriving together are read in one query, and the
+  listener polls once whenever it (re)connects so nothing changed while it was
+  not listening is lost.
+
+Subscribers get lists of dicts of the search columns and must apply them
+idempotently, a process is also fed the rows it wrote itself and a row may
+be delivered again.
+"""
+import asyncio
+import logging
+
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, List
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+
+from .database import AsyncSessionLocal
+from .models import Influencer
+from .search import SEARCH_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = tuple(column.name for column in SEARCH_COLUMNS)
+
+# Channel the trigger of the migrations notifies
+CHANNEL = 'influencer_changes'
+# Seconds the listener waits for more notifications before reading the rows
+NOTIFY_BATCH_WINDOW = 0.005
+
+# When a row last changed
+CHANGED_AT = func.coalesce(Influencer.updated_at, Influencer.created_at)
+
+
+class ChangeFeed:
+    """
+    Background task delivering the inserted and updated influencers to the
+    subscribers, see the module docstring for how changes are found
+    """
+
+    def __init__(self):
+        self.subscribers: List[Callable[[List[dict]], None]] = []
+        self.task = None
+        self.lookback = timedelta(0)
+        # Latest change and highest id seen, and the time of the change of the rows seen within the lookback window
+        self.watermark = None
+        self.last_id = 0
+        self.seen: Dict[int, object] = {}
+        self.delivered = 0
+
+    def subscribe(self, subscriber: Callable[[List[dict]], None]) -> None:
+        self.subscribers.append(subscriber)
+
+    async def prime(self, lookback: float) -> None:
+        """
+        Starts the feed from the latest change in the table. Called before the
+        in-memory state is loaded, so the rows seen here are part of it and every
+        later change is delivered
+        """
+        self.lookback = timedelta(seconds = lookback)
+        async with AsyncSessionLocal() as db:
+            last_id, self.watermark = (await db.execute(select(func.max(Influencer.id), func.max(CHANGED_AT)))).one()
+            self.last_id = last_id or 0
+            if self.watermark is not None:
+                self.seen = dict((await db.execute(select(Influencer.id, CHANGED_AT).filter(CHANGED_AT > self.watermark - self.lookback))).all())
+
+    async def poll(self) -> int:
+        """
+        Delivers the rows changed since the last poll, returns how many there were
+        """
+        statement = select(*SEARCH_COLUMNS, CHANGED_AT)
+        if self.watermark is not None:
+            statement = statement.filter(CHANGED_AT > self.watermark - self.lookback)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(statement)).all()
+        changed = [row for row in rows if self.seen.get(row[0]) != row[-1]]
+        self._record((row[0], row[-1]) for row in rows)
+        self._deliver(changed)
+        return len(changed)
+
+    async def fetch(self, ids: Iterable[int]) -> None:
+        """
+        Delivers the rows of notified ids, even when their change time was seen
+        already since updates made outside the ORM leave updated_at as it was
+        """
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(select(*SEARCH_COLUMNS, CHANGED_AT).filter(Influencer.id.in_(list(ids))))).all()
+        self._record((row[0], row[-1]) for row in rows)
+        self._deliver(rows)
+
+    def observe(self, influencers: List[dict]) -> None:
+        """
+        Records influencers this process wrote and applied itself, so the version
+        moves on right away and polls do not deliver them again
+        """
+        self._record((influencer['id'], influencer['updated_at'] or influencer['created_at']) for influencer in influencers)
+
+    def version(self) -> str:
+        """
+        Version of the influencers as far as the feed has seen them, the same as
+        "table_version" gives once the feed caught up with the table
+        """
+        return format_version(self.last_id, self.watermark)
+
+    def _record(self, changes: Iterable[tuple]) -> None:
+        """
+        Moves the watermark to the latest of the (id, change time) pairs and forgets
+        the rows which fell out of the lookback window
+        """
+        for influencer_id, changed in changes:
+            self.last_id = max(self.last_id, influencer_id)
+            if changed is None:
+                continue
+            self.seen[influencer_id] = changed
+            if self.watermark is None or changed > self.watermark:
+                self.watermark = changed
+        if self.watermark is not None:
+            start = self.watermark - self.lookback
+            self.seen = {influencer_id: changed for influencer_id, changed in self.seen.items() if changed > start}
+
+    def _deliver(self, rows: list) -> None:
+        if not rows:
+            return
+        influencers = [dict(zip(COLUMNS, row)) for row in rows]
+        self.delivered += len(influencers)
+        for subscriber in self.subscribers:
+            try:
+                subscriber(influencers)
+            except Exception:
+                logger.exception('Could not apply the changes of influencers')
+
+    async def poll_forever(self, interval: float) -> None:
+        """
+        Polls every "interval" seconds, used as a background task
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception('Could not poll the changes of influencers')
+
+    async def listen_forever(self, url: str, interval: float) -> None:
+        """
+        Delivers the rows notified on the PostgreSQL database at "url", used as a
+        background task. The connection is checked every "interval" seconds and
+        opened again when it was lost
+        """
+        import asyncpg
+
+        dsn = make_url(url).set(drivername = 'postgresql').render_as_string(hide_password = False)
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                notified = asyncio.Queue()
+                await connection.add_listener(CHANNEL, lambda _connection, _pid, _channel, payload: notified.put_nowait(int(payload)))
+                # Catching up with the changes made while nobody was listening
+                await self.poll()
+                while not connection.is_closed():
+                    try:
+                        ids = {await asyncio.wait_for(notified.get(), interval)}
+                    except asyncio.TimeoutError:
+                        continue
+                    await asyncio.sleep(NOTIFY_BATCH_WINDOW)
+                    while not notified.empty():
+                        ids.add(notified.get_nowait())
+                    await self.fetch(ids)
+            except Exception:
+                logger.exception('Lost the change notifications of influencers')
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(interval)
+
+    def start(self, mode: str, url: str, interval: float) -> None:
+        """
+        Starts feeding changes, "mode" is "notify", "poll" or "auto" (notify on PostgreSQL)
+        """
+        if mode == 'auto':
+            mode = 'notify' if make_url(url).get_backend_name() == 'postgresql' else 'poll'
+        self.task = asyncio.create_task(self.listen_forever(url, interval) if mode == 'notify' else self.poll_forever(interval))
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+async def table_version(db) -> str:
+    """
+    Version of the influencers read from the table, it changes with every insert
+    and with every update which sets updated_at (as the ORM does). Served by
+    the primary key and the index on the change time
+    """
+    last_id, changed = (await db.execute(select(func.max(Influencer.id), func.max(CHANGED_AT)))).one()
+    return format_version(last_id or 0, changed)
+
+
+def format_version(last_id: int, changed) -> str:
+    return f"{last_id}:{changed.isoformat() if changed is not None else ''}"
+
+
+change_feed = ChangeFeed()
@@ -7,11 +7,118 @@ load_dotenv()
 
 class Settings(BaseSettings):
     DB_URL: str = os.environ["DB_URL"]
+    # Defaults to DB_URL with its driver swapped for an asyncio one
+    ASYNC_DB_URL: str = os.environ.get("ASYNC_DB_URL", "")
+
+    # Connection pool of the async engine, a size of 0 disables pooling
+    DB_POOL_SIZE: int = os.environ.get("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW: int = os.environ.get("DB_MAX_OVERFLOW", 10)
+    DB_POOL_TIMEOUT: float = os.environ.get("DB_POOL_TIMEOUT", 30)
+    # Seconds after which connections are replaced (-1 never), and whether connections are
+    # tested before being handed out so ones dropped by the server are not used
+    DB_POOL_RECYCLE: int = os.environ.get("DB_POOL_RECYCLE", 1800)
+    DB_POOL_PRE_PING: bool = os.environ.get("DB_POOL_PRE_PING", True)
+    # Connections opened at startup so the first requests do not wait for them, defaults to DB_POOL_SIZE
+    DB_POOL_PREWARM: int = os.environ.get("DB_POOL_PREWARM", os.environ.get("DB_POOL_SIZE", 5))
+
+    # Comma separated URLs of read replicas used by read-only routes, replicas are picked
+    # "round_robin" or "least_loaded" and skipped for DB_REPLICA_RETRY_SECONDS after failing
+    DB_REPLICA_URLS: str = os.environ.get("DB_REPLICA_URLS", "")
+    DB_REPLICA_STRATEGY: str = os.environ.get("DB_REPLICA_STRATEGY", "round_robin")
+    DB_REPLICA_RETRY_SECONDS: float = os.environ.get("DB_REPLICA_RETRY_SECONDS", 30)
+    # Seconds a client's reads stay on the primary after it wrote
+    DB_REPLICA_STICKY_SECONDS: int = os.environ.get("DB_REPLICA_STICKY_SECONDS", 5)
 
     ACCESS_TOKEN_EXPIRES_IN: int = os.environ["ACCESS_TOKEN_EXPIRES_IN"]
     REFRESH_TOKEN_EXPIRES_IN: int = os.environ["REFRESH_TOKEN_EXPIRES_IN"]
 
     JWT_SECRET_KEY: str = os.environ["JWT_SECRET_KEY"]
+    # "database" looks the user of a token up on every request, "stateless" trusts the
+    # token and only looks its user up once every AUTH_REFRESH_INTERVAL seconds, keeping
+    # the ids of up to AUTH_CACHE_SIZE users found to exist in memory meanwhile
+    AUTH_MODE: str = os.environ.get("AUTH_MODE", "database")
+    AUTH_REFRESH_INTERVAL: float = os.environ.get("AUTH_REFRESH_INTERVAL", 60)
+    AUTH_CACHE_SIZE: int = os.environ.get("AUTH_CACHE_SIZE", 100000)
+
+    # Cost factor of password hashes, existing hashes are upgraded when their owner logs in
+    BCRYPT_ROUNDS: int = os.environ.get("BCRYPT_ROUNDS", 10)
+    # Threads hashing passwords and how many more hashes may wait for them before returning 503
+    PASSWORD_HASH_WORKERS: int = os.environ.get("PASSWORD_HASH_WORKERS", 4)
+    PASSWORD_HASH_QUEUE: int = os.environ.get("PASSWORD_HASH_QUEUE", 64)
+
+    # Token bucket rate limits of logins and registrations per client IP and per email, in requests
+    # per minute (0 disables a limit) with bursts of up to *_BURST_* requests. Buckets of the
+    # RATE_LIMIT_MAX_KEYS most recently seen IPs and emails are kept
+    LOGIN_RATE_PER_IP: float = os.environ.get("LOGIN_RATE_PER_IP", 30)
+    LOGIN_BURST_PER_IP: int = os.environ.get("LOGIN_BURST_PER_IP", 30)
+    LOGIN_RATE_PER_EMAIL: float = os.environ.get("LOGIN_RATE_PER_EMAIL", 5)
+    LOGIN_BURST_PER_EMAIL: int = os.environ.get("LOGIN_BURST_PER_EMAIL", 5)
+    REGISTER_RATE_PER_IP: float = os.environ.get("REGISTER_RATE_PER_IP", 10)
+    REGISTER_BURST_PER_IP: int = os.environ.get("REGISTER_BURST_PER_IP", 10)
+    REGISTER_RATE_PER_EMAIL: float = os.environ.get("REGISTER_RATE_PER_EMAIL", 5)
+    REGISTER_BURST_PER_EMAIL: int = os.environ.get("REGISTER_BURST_PER_EMAIL", 5)
+    RATE_LIMIT_MAX_KEYS: int = os.environ.get("RATE_LIMIT_MAX_KEYS", 100000)
+
+    SEARCH_DEFAULT_LIMIT: int = os.environ.get("SEARCH_DEFAULT_LIMIT", 50)
+    SEARCH_MAX_LIMIT: int = os.environ.get("SEARCH_MAX_LIMIT", 500)
+    # Either "database", "index" (in-process search index built at startup), "snapshot" (see
+    # below) or "sharded" (influencers split between SEARCH_WORKERS processes searching their
+    # shard in parallel)
+    SEARCH_ENGINE: str = os.environ.get("SEARCH_ENGINE", "database")
+    SEARCH_WORKERS: int = os.environ.get("SEARCH_WORKERS", os.cpu_count() or 1)
+    # With SEARCH_ENGINE "snapshot" searches are answered from a columnar snapshot of the
+    # influencers. When a path is set the snapshot is saved there and memory-mapped, workers
+    # starting within SEARCH_SNAPSHOT_MAX_AGE seconds of it map the same file
+    SEARCH_SNAPSHOT_PATH: str = os.environ.get("SEARCH_SNAPSHOT_PATH", "")
+    SEARCH_SNAPSHOT_MAX_AGE: float = os.environ.get("SEARCH_SNAPSHOT_MAX_AGE", 300)
+
+    # Keep a bigram index of the usernames in memory for fuzzy searches, PostgreSQL's trigram index
+    # is used otherwise. Misspellings up to FUZZY_MAX_DISTANCE edits away can be searched for, the
+    # candidates to check grow quickly with the distance when usernames look alike so searches
+    # leaving more than FUZZY_MAX_CANDIDATES usernames to check are refused with a 400
+    FUZZY_SEARCH: bool = os.environ.get("FUZZY_SEARCH", True)
+    FUZZY_MAX_DISTANCE: int = os.environ.get("FUZZY_MAX_DISTANCE", 2)
+    FUZZY_MAX_CANDIDATES: int = os.environ.get("FUZZY_MAX_CANDIDATES", 1000)
+
+    # Keep Bloom filters of the emails and usernames in use, so registrations, imports and username
+    # availability checks skip the lookup of values certainly free. The filters are sized for at
+    # least UNIQUENESS_FILTER_CAPACITY values with UNIQUENESS_FILTER_ERROR_RATE false positives
+    UNIQUENESS_FILTER: bool = os.environ.get("UNIQUENESS_FILTER", True)
+    UNIQUENESS_FILTER_CAPACITY: int = os.environ.get("UNIQUENESS_FILTER_CAPACITY", 100000)
+    UNIQUENESS_FILTER_ERROR_RATE: float = os.environ.get("UNIQUENESS_FILTER_ERROR_RATE", 0.01)
+
+    # Feed the inserts and updates of influencers made by any process to the in-memory state
+    # of every process. "notify" listens to the trigger added by the migrations (PostgreSQL),
+    # "poll" reads the rows changed since the last poll every CHANGE_FEED_INTERVAL seconds,
+    # "auto" picks "notify" on PostgreSQL and "poll" otherwise, "off" disables the feed.
+    # Polls look CHANGE_FEED_LOOKBACK seconds behind the last change for late commits
+    CHANGE_FEED: str = os.environ.get("CHANGE_FEED", "auto")
+    CHANGE_FEED_INTERVAL: float = os.environ.get("CHANGE_FEED_INTERVAL", 0.5)
+    CHANGE_FEED_LOOKBACK: float = os.environ.get("CHANGE_FEED_LOOKBACK", 5)
+
+    # Onboarding inserts arriving within this many milliseconds of each other are written
+    # together and share one commit, up to ONBOARDING_MAX_BATCH of them
+    ONBOARDING_BATCH_WINDOW_MS: float = os.environ.get("ONBOARDING_BATCH_WINDOW_MS", 2)
+    ONBOARDING_MAX_BATCH: int = os.environ.get("ONBOARDING_MAX_BATCH", 100)
+
+    # Keep the follower counts of all influencers in memory to answer histograms
+    FOLLOWER_SUMMARY: bool = os.environ.get("FOLLOWER_SUMMARY", True)
+
+    # Secret expected in the "X-Import-Token" header of bulk imports, they are disabled when empty
+    BULK_IMPORT_TOKEN: str = os.environ.get("BULK_IMPORT_TOKEN", "")
+
+    # Requests slower than this many milliseconds get their sampled stacks written to
+    # PROFILE_DIR as folded stacks (for flamegraphs), 0 disables the sampling profiler
+    PROFILE_SLOW_REQUEST_MS: float = os.environ.get("PROFILE_SLOW_REQUEST_MS", 0)
+    PROFILE_INTERVAL_MS: float = os.environ.get("PROFILE_INTERVAL_MS", 5)
+    PROFILE_DIR: str = os.environ.get("PROFILE_DIR", "profiles")
+
+    # Amount of search responses kept in the cache (0 disables it) and seconds they are kept for
+    SEARCH_CACHE_SIZE: int = os.environ.get("SEARCH_CACHE_SIZE", 1024)
+    SEARCH_CACHE_TTL: float = os.environ.get("SEARCH_CACHE_TTL", 30)
+    # Search responses of at least this many bytes are compressed with brotli (when installed)
+    # or gzip for clients accepting it, 0 disables compression
+    SEARCH_COMPRESS_MIN_SIZE: int = os.environ.get("SEARCH_COMPRESS_MIN_SIZE", 1024)
 
 
 settings = Settings()
\ No newline at end of file
@@ -1,18 +1,238 @@
+import asyncio
+import functools
+import itertools
+import time
+
+from fastapi import Request
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
 from .config import settings
+from .metrics import instrument_engine, timed_pool
+
+
+def async_url(url: str) -> str:
+    """
+    Swaps the driver of a database URL for its asyncio counterpart
+    (asyncpg for PostgreSQL and aiosqlite for SQLite)
+    """
+    scheme, rest = url.split('://', 1)
+    dialect = scheme.split('+')[0]
+    if dialect in ('postgres', 'postgresql'):
+        return 'postgresql+asyncpg://' + rest
+    if dialect == 'sqlite':
+        return 'sqlite+aiosqlite://' + rest
+    return url
+
+
+def engine_options(url: str, name: str) -> dict:
+    """
+    Pool options for an engine, "name" labels its pool in the metrics. SQLite
+    is only used as a local stand-in so it keeps its default pool and may be
+    shared between threads
+    """
+    options = {'pool_logging_name': name, 'pool_pre_ping': settings.DB_POOL_PRE_PING, 'pool_recycle': settings.DB_POOL_RECYCLE}
+    database_url = make_url(url)
+    pool_class = database_url.get_dialect().get_pool_class(database_url)
+    if url.startswith('sqlite'):
+        options['connect_args'] = {'check_same_thread': False}
+    elif settings.DB_POOL_SIZE == 0:
+        pool_class = NullPool
+    else:
+        options.update(pool_size = settings.DB_POOL_SIZE, max_overflow = settings.DB_MAX_OVERFLOW, pool_timeout = settings.DB_POOL_TIMEOUT)
+    # Timing the checkouts of the pool
+    options['poolclass'] = timed_pool(pool_class)
+    return options
+
+
+class LazySessionmaker(sessionmaker):
+    """
+    Session factory binding itself to the engine returned by "create_bind" when
+    the first session is made, so importing the app does not create engines
+    """
+
+    def __init__(self, create_bind, **kw):
+        super().__init__(**kw)
+        self.create_bind = create_bind
+
+    def __call__(self, **local_kw):
+        if self.kw.get('bind') is None:
+            self.configure(bind = self.create_bind())
+        return super().__call__(**local_kw)
+
+
+@functools.lru_cache(maxsize = None)
+def get_engine():
+    """
+    Synchronous engine, used by scripts and code running outside of requests
+    """
+    engine = create_engine(settings.DB_URL, **engine_options(settings.DB_URL, 'sync'))
+    instrument_engine(engine)
+    return engine
 
-engine = create_engine(settings.DB_URL)
 
-Session = sessionmaker(autocommit = False, autoflush = False, bind = engine)
+@functools.lru_cache(maxsize = None)
+def get_async_engine():
+    """
+    Asyncio engine used by the endpoints so queries do not block the event loop
+    """
+    url = settings.ASYNC_DB_URL or async_url(settings.DB_URL)
+    async_engine = create_async_engine(url, **engine_options(url, 'primary'))
+    instrument_engine(async_engine.sync_engine)
+    return async_engine
+
+
+Session = LazySessionmaker(get_engine, autocommit = False, autoflush = False)
+
+AsyncSessionLocal = LazySessionmaker(get_async_engine, autocommit = False, autoflush = False, expire_on_commit = False, class_ = AsyncSession)
 
 Base = declarative_base()
 
-def get_db():
-    db = Session()
+# Cookie set after a write, until the time it holds reads go to the primary so the
+# writer sees its own writes while replicas catch up
+READ_PRIMARY_COOKIE = 'read_primary_until'
+
+
+class ReplicaRouter:
+    """
+    Picks the engine read-only queries run on: one of the replicas, chosen
+    round-robin or by the least connections in use, or the primary when there
+    are no replicas or all of them failed in the last "retry_after" seconds
+    """
+
+    def __init__(self, primary, replicas: list, strategy: str, retry_after: float):
+        self.primary = primary
+        self.replicas = replicas
+        self.strategy = strategy
+        self.retry_after = retry_after
+        self.down_until = {}
+        self.rotation = itertools.cycle(replicas)
+
+    def choose(self):
+        now = time.monotonic()
+        available = [replica for replica in self.replicas if self.down_until.get(replica, 0) <= now]
+        if not available:
+            return self.primary
+        if self.strategy == 'least_loaded':
+            return min(available, key = lambda replica: getattr(replica.sync_engine.pool, 'checkedout', lambda: 0)())
+        for replica in self.rotation:
+            if replica in available:
+                return replica
+
+    def mark_down(self, replica) -> None:
+        self.down_until[replica] = time.monotonic() + self.retry_after
+
+
+@functools.lru_cache(maxsize = None)
+def get_replica_engines() -> list:
+    """
+    Asyncio engines of the read replicas listed in DB_REPLICA_URLS
+    """
+    urls = [async_url(url.strip()) for url in settings.DB_REPLICA_URLS.split(',') if url.strip()]
+    engines = [create_async_engine(url, **engine_options(url, f'replica{index}')) for index, url in enumerate(urls)]
+    for engine in engines:
+        instrument_engine(engine.sync_engine)
+    return engines
+
+
+@functools.lru_cache(maxsize = None)
+def get_replica_router() -> ReplicaRouter:
+    """
+    Router of the read-only sessions between the primary and its replicas
+    """
+    return ReplicaRouter(get_async_engine(), get_replica_engines(), settings.DB_REPLICA_STRATEGY, settings.DB_REPLICA_RETRY_SECONDS)
+
+
+async def prewarm(async_engine, connections: int) -> None:
+    """
+    Opens up to "connections" connections of an engine's pool at once and
+    returns them to it, so the first requests after a deploy do not pay for
+    the TCP and authentication handshakes
+    """
+    pool = async_engine.sync_engine.pool
+    connections = min(connections, pool.size() if hasattr(pool, 'size') else 0)
+    if connections <= 0:
+        return
+    opened = await asyncio.gather(*(async_engine.connect() for _ in range(connections)), return_exceptions = True)
+    await asyncio.gather(*(connection.close() for connection in opened if not isinstance(connection, BaseException)))
+    for connection in opened:
+        if isinstance(connection, BaseException):
+            raise connection
+
+
+class ReplicaSession(AsyncSession):
+    """
+    Read-only session on a replica. Like any session it only checks a connection
+    out for its first statement, so requests answered without a query never touch
+    the replica. When the replica can not be reached then it is marked down and
+    the session moves to the primary
+    """
+
+    def __init__(self, *args, router: ReplicaRouter = None, **kw):
+        super().__init__(*args, **kw)
+        # Router of the replica until the session is connected
+        self.router = router
+
+    async def connection(self, **kw):
+        if self.router is not None:
+            router, self.router = self.router, None
+            try:
+                return await super().connection(**kw)
+            except (DBAPIError, OSError):
+                router.mark_down(self.bind)
+                await self.close()
+                self.bind = router.primary
+                self.sync_session.bind = router.primary.sync_engine
+        return await super().connection(**kw)
+
+    async def execute(self, *args, **kw):
+        if self.router is not None:
+            await self.connection()
+        return await super().execute(*args, **kw)
+
+    async def stream(self, *args, **kw):
+        if self.router is not None:
+            await self.connection()
+        return await super().stream(*args, **kw)
+
+
+ReplicaSessionLocal = LazySessionmaker(get_async_engine, autocommit = False, autoflush = False, expire_on_commit = False, class_ = ReplicaSession)
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def get_read_db(request: Request):
+    """
+    Session for read-only routes, running on a replica unless the client wrote
+    recently. Falls back to the primary if the replica can not be reached
+    """
+    try:
+        read_primary = float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) >= time.time()
+    except ValueError:
+        read_primary = False
+
+    replica_router = get_replica_router()
+    engine = replica_router.primary if read_primary else replica_router.choose()
+    if engine is replica_router.primary:
+        db = AsyncSessionLocal()
+    else:
+        db = ReplicaSessionLocal(bind = engine, router = replica_router)
+
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        await db.close()
+
+def read_your_writes(response) -> None:
+    """
+    Sends the client's reads to the primary for the next few seconds, called after writes
+    """
+    until = time.time() + settings.DB_REPLICA_STICKY_SECONDS
+    response.set_cookie(READ_PRIMARY_COOKIE, str(until), settings.DB_REPLICA_STICKY_SECONDS, settings.DB_REPLICA_STICKY_SECONDS, '/', None, False, True, 'lax')
@@ -0,0 +1,105 @@
+import gzip
+import hashlib
+import json
+
+from datetime import datetime
+from typing import Any, Optional, Tuple
+
+from starlette.responses import JSONResponse
+
+from .metrics import timed
+
+# orjson is a lot faster than the json module, it is used when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Brotli compresses JSON better than gzip, it is offered when it is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression settings trading a little ratio for speed, bodies are compressed once and cached
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{value.__class__.__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Encodes plain python data (dicts, lists, strings, numbers and datetimes) as JSON
+    """
+    if orjson:
+        return orjson.dumps(content)
+    return json.dumps(content, default = _default, ensure_ascii = False, separators = (',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered with "dumps", the time spent is added to the
+    "serialization" phase of the request metrics
+    """
+
+    def render(self, content: Any) -> bytes:
+        with timed('serialization'):
+            return dumps(content)
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Picks the compression of a response from the Accept-Encoding header of the
+    request, brotli over gzip, None when the client accepts neither
+    """
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        coding, _, parameters = part.partition(';')
+        parameters = parameters.strip()
+        try:
+            quality = float(parameters[2:]) if parameters.startswith('q=') else 1.0
+        except ValueError:
+            quality = 0.0
+        if quality > 0:
+            accepted.add(coding.strip())
+    if brotli and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str], min_size: int) -> Tuple[bytes, Optional[str]]:
+    """
+    Compresses a body with "encoding" if it is at least "min_size" bytes long (0
+    never compresses), returns the body and the encoding actually applied
+    """
+    if not encoding or not min_size or len(body) < min_size:
+        return body, None
+    if encoding == 'br':
+        return brotli.compress(body, quality = BROTLI_QUALITY), encoding
+    return gzip.compress(body, GZIP_LEVEL, mtime = 0), encoding
+
+
+def etag(*parts) -> str:
+    """
+    Strong entity tag of a representation identified by "parts"
+    """
+    return '"' + hashlib.blake2b(repr(parts).encode('utf-8'), digest_size = 16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], tag: str) -> bool:
+    """
+    Tells if an If-None-Match header lists "tag", compared the weak way as
+    conditional GETs do
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(candidate.strip() in (tag, f'W/{tag}') for candidate in if_none_match.split(','))
@@ -0,0 +1,117 @@
+import bisect
+
+from array import array
+from typing import List, Optional
+
+from sqlalchemy import case, func, select
+
+from .models import Influencer
+from .search import filter_influencers
+
+# Amount of log scale buckets, the last one holds every count from 10 ** (LOG_BUCKETS - 2) up
+LOG_BUCKETS = 11
+
+
+def log_buckets() -> List[int]:
+    """
+    Lower bounds of the default buckets: 0, 1, 10, 100 ...
+    """
+    return [0] + [10 ** power for power in range(LOG_BUCKETS - 1)]
+
+
+def bucket_ranges(bounds: List[int]) -> List[dict]:
+    """
+    Turns the lower bounds of buckets into their inclusive (min, max) ranges,
+    the last bucket has no maximum
+    """
+    return [{'min': low, 'max': high - 1 if high is not None else None} for low, high in zip(bounds, bounds[1:] + [None])]
+
+
+class FollowerSummary:
+    """
+    Sorted follower counts of all influencers kept in a compact array, loaded at
+    startup and kept up to date on onboarding and by the change feed. The amount
+    of influencers in any follower range is found with two bisections, so
+    histograms do not depend on the size of the table. The count of every id is
+    kept too (ids sorted in another array) so adding an influencer twice or
+    changing its follower count does not skew the counts
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.counts = array('q')
+        self.ids = array('q')
+        self.id_counts = array('q')
+
+    async def load(self, db) -> None:
+        """
+        Loads the follower counts of all influencers from the DB
+        """
+        result = await db.execute(select(Influencer.id, Influencer.follower_count).order_by(Influencer.id))
+        rows = result.all()
+        self.ids = array('q', (row[0] for row in rows))
+        self.id_counts = array('q', (row[1] for row in rows))
+        self.counts = array('q', sorted(self.id_counts))
+        self.ready = True
+
+    def add(self, influencer_id: int, follower_count: int) -> None:
+        """
+        Adds an influencer or updates the follower count of a known one
+        """
+        if not self.ready:
+            return
+        index = bisect.bisect_left(self.ids, influencer_id)
+        if index < len(self.ids) and self.ids[index] == influencer_id:
+            previous = self.id_counts[index]
+            if previous == follower_count:
+                return
+            del self.counts[bisect.bisect_left(self.counts, previous)]
+            self.id_counts[index] = follower_count
+        else:
+            self.ids.insert(index, influencer_id)
+            self.id_counts.insert(index, follower_count)
+        bisect.insort(self.counts, follower_count)
+
+    def count(self, low: int, high: Optional[int] = None) -> int:
+        """
+        Amount of influencers with at least "low" and less than "high" followers
+        """
+        end = bisect.bisect_left(self.counts, high) if high is not None else len(self.counts)
+        return max(0, end - bisect.bisect_left(self.counts, low))
+
+    def histogram(self, bounds: List[int]) -> List[int]:
+        return [self.count(low, high) for low, high in zip(bounds, bounds[1:] + [None])]
+
+
+def bucket_expression(bounds: List[int]):
+    """
+    SQL expression giving the index of the bucket of an influencer's follower count
+    """
+    return case(*[(Influencer.follower_count >= low, index) for index, low in reversed(list(enumerate(bounds)))], else_ = None)
+
+
+async def histogram_from_db(db, bounds: List[int], keyword: Optional[str] = None) -> List[int]:
+    """
+    Counts the influencers (matching the keyword if given) in each bucket with
+    a single GROUP BY query
+    """
+    bucket = bucket_expression(bounds)
+    statement = filter_influencers(select(bucket, func.count(Influencer.id)), keyword).group_by(bucket)
+    counts = dict((await db.execute(statement)).all())
+    return [counts.get(index, 0) for index in range(len(bounds))]
+
+
+def histogram_from_index(search_index, bounds: List[int], keyword: str) -> List[int]:
+    """
+    Counts the influencers matching the keyword in each bucket with a single
+    pass over the matches of the search index
+    """
+    counts = [0] * len(bounds)
+    for influencer_id in search_index.matches(keyword.lower()):
+        index = bisect.bisect_right(bounds, search_index.documents[influencer_id]['follower_count']) - 1
+        if index >= 0:
+            counts[index] += 1
+    return counts
+
+
+follower_summary = FollowerSummary()
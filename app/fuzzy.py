@@ -0,0 +1,240 @@
+import asyncio
+
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from sqlalchemy import func, select
+
+from .config import settings
+from .models import Influencer
+from .search import SEARCH_COLUMNS
+
+# Candidates fetched per requested result when PostgreSQL's trigram index picks them
+DB_CANDIDATES_PER_RESULT = 10
+# Most bigrams of a search a username has to share among the rarest ones read from the index
+FILTER_BIGRAMS = 8
+
+
+def edit_distance(a: str, b: str) -> int:
+    """
+    Levenshtein distance between two strings, the least amount of single
+    character insertions, deletions and substitutions turning one into the other
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def bounded_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Levenshtein distance between two strings when it is at most "max_distance",
+    "max_distance" + 1 otherwise. Only the cells within "max_distance" of the
+    diagonal are computed and it stops as soon as a whole row is past the bound
+    """
+    over = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return over
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i if i <= max_distance else over] + [over] * len(b)
+        for j in range(max(1, i - max_distance), min(len(b), i + max_distance) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != b[j - 1]), over)
+        if min(current) > max_distance:
+            return over
+        previous = current
+    return previous[-1]
+
+
+def positional_bigrams(word: str) -> List[Tuple[int, str]]:
+    """
+    (Position, bigram) pairs of a word padded with a start and an end mark, so
+    its first and last characters are part of two bigrams like the others
+    """
+    padded = f'\x02{word}\x03'
+    return [(position, padded[position:position + 2]) for position in range(len(padded) - 1)]
+
+
+class UsernameIndex:
+    """
+    Index of the lower cased usernames of influencers for fuzzy searches.
+
+    Usernames are bucketed by length and their padded bigrams are posted by
+    (length, position, bigram). An edit changes at most two bigrams of a word
+    and moves the others by at most one position, so a username within k edits
+    of the searched one has a close length and shares all but 2k of its
+    bigrams at positions at most k apart. A username sharing that many shares
+    at least t of any 2k + t of them, so only the postings of the 2k + t rarest
+    bigrams are read and counted (prefix filter). The count of all shared
+    bigrams of the remaining candidates is then checked from the username
+    itself, and only the ones passing get an edit distance giving up past k.
+    Searches which would still have to check more than "max_candidates"
+    usernames, as with short usernames for their distance, are refused with
+    ValueError
+    """
+
+    def __init__(self, max_candidates: int = 1000):
+        self.ready = False
+        self.max_candidates = max_candidates
+        self._reset()
+
+    def _reset(self) -> None:
+        # Distinct usernames by number, the ids of the influencers having each of
+        # them and the number of the username of every influencer id
+        self.words: List[str] = []
+        self.numbers: Dict[str, int] = {}
+        self.ids: List[List[int]] = []
+        self.by_id: Dict[int, int] = {}
+        # Numbers of the usernames having each length, and holding each bigram at a position for a length
+        self.lengths: Dict[int, List[int]] = {}
+        self.grams: Dict[Tuple[int, int, str], List[int]] = {}
+
+    async def load(self, db) -> None:
+        """
+        Indexes the usernames of all influencers in the DB, the index is built in a
+        thread so the other warm-up steps can await the database meanwhile
+        """
+        rows = (await db.execute(select(Influencer.id, Influencer.username))).all()
+        await asyncio.get_running_loop().run_in_executor(None, self._build, rows)
+        self.ready = True
+
+    def _build(self, rows: List[tuple]) -> None:
+        self._reset()
+        for influencer_id, username in rows:
+            self._insert(username.lower(), influencer_id)
+
+    def add(self, influencer_id: int, username: str) -> None:
+        """
+        Adds an influencer or moves it to its new username, usernames are never
+        removed so one nobody has anymore stays in the index without ids
+        """
+        if self.ready:
+            self._insert(username.lower(), influencer_id)
+
+    def _insert(self, word: str, influencer_id: int) -> None:
+        previous = self.by_id.get(influencer_id)
+        if previous is not None:
+            if self.words[previous] == word:
+                return
+            self.ids[previous].remove(influencer_id)
+
+        number = self.numbers.get(word)
+        if number is None:
+            number = self.numbers[word] = len(self.words)
+            self.words.append(word)
+            self.ids.append([])
+            self.lengths.setdefault(len(word), []).append(number)
+            for position, gram in positional_bigrams(word):
+                self.grams.setdefault((len(word), position, gram), []).append(number)
+        self.ids[number].append(influencer_id)
+        self.by_id[influencer_id] = number
+
+    def candidates(self, word: str, max_distance: int) -> List[int]:
+        """
+        Numbers of the usernames which may be within "max_distance" edits of
+        "word": their length is close enough and they share enough of its
+        bigrams at close enough positions. Raises ValueError when there are
+        more than "max_candidates" usernames to check
+        """
+        grams = positional_bigrams(word)
+        needed = len(grams) - 2 * max_distance
+        lengths = [length for length in range(max(0, len(word) - max_distance), len(word) + max_distance + 1) if length in self.lengths]
+
+        if needed <= 0:
+            # Too short for the bigrams to tell anything, every username of a close length is a candidate
+            found = set()
+            for length in lengths:
+                found.update(self.lengths[length])
+                if len(found) > self.max_candidates:
+                    raise ValueError(self._too_broad(word, max_distance))
+            return list(found)
+
+        # A username sharing "needed" of the bigrams shares at least "least" of any
+        # 2k + "least" of them, those are read from the rarest bigrams' postings
+        least = min(needed, FILTER_BIGRAMS)
+        reach = [
+            [self.grams[key] for length in lengths for shift in range(-max_distance, max_distance + 1) if (key := (length, position + shift, gram)) in self.grams]
+            for position, gram in grams
+        ]
+        reach.sort(key = lambda lists: sum(map(len, lists)))
+        shared = Counter()
+        for lists in reach[:2 * max_distance + least]:
+            shared.update(set().union(*lists))
+        found = [number for number, count in shared.items() if count >= least]
+        if len(found) > self.max_candidates:
+            raise ValueError(self._too_broad(word, max_distance))
+        return [number for number in found if self._shared(number, grams, max_distance) >= needed]
+
+    @staticmethod
+    def _too_broad(word: str, max_distance: int) -> str:
+        return f'Too many usernames are within {max_distance} edits of "{word}", search with a longer username or fewer edits'
+
+    def _shared(self, number: int, grams: List[Tuple[int, str]], max_distance: int) -> int:
+        """
+        Counts the bigrams of a search found in a username at most "max_distance" positions away
+        """
+        padded = f'\x02{self.words[number]}\x03'
+        return sum(
+            any(padded[start:start + 2] == gram for start in range(max(0, position - max_distance), position + max_distance + 1))
+            for position, gram in grams
+        )
+
+    def search(self, username: str, max_distance: int) -> List[Tuple[int, int]]:
+        """
+        Returns (distance, influencer id) pairs of the influencers whose username is
+        within "max_distance" edits of "username", closest first. Raises ValueError
+        when the search would have to check too many usernames
+        """
+        word = username.lower()
+        found = []
+        for number in self.candidates(word, max_distance):
+            distance = bounded_distance(word, self.words[number], max_distance)
+            if distance <= max_distance:
+                found += [(distance, influencer_id) for influencer_id in self.ids[number]]
+        return sorted(found)
+
+
+async def fuzzy_from_index(db, index: UsernameIndex, username: str, max_distance: int, limit: int) -> List[dict]:
+    """
+    Influencers with the closest usernames found by the index, closest first and
+    then by follower count. Only the influencers returned are read from the DB
+    """
+    # Run on the event loop, a thread would hold the GIL all the same. The work is bounded
+    # by the candidates a search may check, a few milliseconds at most
+    found = index.search(username, max_distance)
+    # Influencers further away than the "limit"-th closest one can not make it into the results
+    if len(found) > limit:
+        found = [(distance, influencer_id) for distance, influencer_id in found if distance <= found[limit - 1][0]]
+    distances = {influencer_id: distance for distance, influencer_id in found}
+    if not distances:
+        return []
+    rows = (await db.execute(select(*SEARCH_COLUMNS).filter(Influencer.id.in_(list(distances))))).all()
+    return closest([dict(row._mapping, distance = distances[row.id]) for row in rows], limit)
+
+
+async def fuzzy_from_db(db, username: str, max_distance: int, limit: int) -> List[dict]:
+    """
+    Influencers with the closest usernames on PostgreSQL. The trigram index on the
+    lower cased usernames picks the most similar candidates (pg_trgm's "%"
+    operator), only those are checked for their edit distance. Very short
+    usernames share few trigrams, so some of their misspellings are not found
+    """
+    username = username.lower()
+    lowered = func.lower(Influencer.username)
+    statement = select(*SEARCH_COLUMNS).filter(lowered.op('%')(username)).order_by(func.similarity(lowered, username).desc()).limit(limit * DB_CANDIDATES_PER_RESULT)
+    candidates = [dict(row._mapping, distance = edit_distance(username, row.username.lower())) for row in (await db.execute(statement)).all()]
+    return closest([candidate for candidate in candidates if candidate['distance'] <= max_distance], limit)
+
+
+def closest(influencers: List[dict], limit: int) -> List[dict]:
+    return sorted(influencers, key = lambda influencer: (influencer['distance'], -influencer['follower_count'], -influencer['id']))[:limit]
+
+
+username_index = UsernameIndex(settings.FUZZY_MAX_CANDIDATES)
@@ -0,0 +1,280 @@
+"""
+Bulk import of influencers (a user and its influencer profile per row) from
+NDJSON or CSV. Rows are validated, checked for conflicts and written in
+batches with multi-row INSERTs, rows which fail are reported without
+aborting the rest of the import.
+
+Usage from the command line:
+    python -m app.ingest influencers.ndjson [--format csv] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+
+from typing import AsyncIterator, Callable, Iterable, List, Optional
+
+from pydantic import BaseModel, EmailStr, ValidationError, constr, root_validator
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .database import AsyncSessionLocal
+from .models import User, Influencer
+from .utils import hash_password, password_pool, PasswordPoolSaturated
+
+# Maximum amount of row errors kept in a report, the total is always counted
+MAX_REPORTED_ERRORS = 1000
+# Passwords hashed per job of the password pool
+HASH_CHUNK_SIZE = 8
+# Hashes made by bcrypt ($2a$, $2b$ or $2y$, the cost and 53 characters of salt and checksum)
+BCRYPT_HASH = r'^\$2[aby]\$\d\d\$[./A-Za-z0-9]{53}$'
+
+
+class BulkRow(BaseModel):
+    email: EmailStr
+    # Either a plain password which gets hashed or an existing bcrypt hash
+    password: Optional[constr(min_length = 8)] = None
+    password_hash: Optional[constr(regex = BCRYPT_HASH)] = None
+    username: str
+    follower_count: int
+    bio: Optional[constr(max_length = 100)] = None
+
+    @root_validator(skip_on_failure = True)
+    def check_password(cls, values):
+        if not values.get('password') and not values.get('password_hash'):
+            raise ValueError('Either password or password_hash is required')
+        return values
+
+
+class IngestReport:
+    """
+    Counts of an import and the errors of rows which were not imported
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, row: int, detail: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'detail': detail})
+
+    def dict(self) -> dict:
+        return {'rows': self.rows, 'inserted': self.inserted, 'error_count': self.error_count, 'errors': self.errors}
+
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    """
+    Hashes a list of passwords, used to hash a chunk of a batch as one job of the password pool
+    """
+    return [hash_password(password) for password in passwords]
+
+
+async def hash_passwords_pooled(passwords: List[str]) -> List[str]:
+    """
+    Hashes the passwords of a batch on the password pool in chunks of HASH_CHUNK_SIZE,
+    running on at most PASSWORD_HASH_WORKERS threads at once so logins and
+    registrations still find room in the pool
+    """
+    semaphore = asyncio.Semaphore(settings.PASSWORD_HASH_WORKERS)
+
+    async def run(chunk: List[str]) -> List[str]:
+        async with semaphore:
+            return await password_pool.run(hash_passwords, chunk)
+
+    chunks = [passwords[start:start + HASH_CHUNK_SIZE] for start in range(0, len(passwords), HASH_CHUNK_SIZE)]
+    return [hash for hashes in await asyncio.gather(*(run(chunk) for chunk in chunks)) for hash in hashes]
+
+
+async def parse_rows(lines: AsyncIterator[bytes], format: str) -> AsyncIterator[tuple]:
+    """
+    Turns NDJSON or CSV lines into (row number, dict) tuples, rows which can
+    not be parsed (or are not UTF-8) are given as (row number, error message).
+    A CSV row spans several lines when a quoted value holds line breaks
+    """
+    header = None
+    number = 0
+    record, quotes = [], 0
+    async for line in lines:
+        if not record and not line.strip():
+            continue
+        if format == 'csv':
+            # Gathering lines until every quote is closed, escaped quotes ("") count twice
+            record.append(line)
+            quotes += line.count(b'"')
+            if quotes % 2:
+                continue
+            line, record, quotes = b'\n'.join(record), [], 0
+            if header is None:
+                header = next(csv.reader([line.decode('utf-8', 'replace')]))
+                continue
+        number += 1
+        try:
+            if format == 'csv':
+                values = next(csv.reader([line.decode('utf-8')]))
+                yield number, {key: value for key, value in zip(header, values) if value != ''}
+            else:
+                yield number, json.loads(line.decode('utf-8'))
+        except (ValueError, StopIteration, csv.Error) as e:
+            yield number, f'Could not parse row: {e}'
+    if record:
+        yield number + 1, 'Could not parse row: a quoted value is never closed'
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Splits a stream of bytes (e.g. a request body) into lines, they are decoded
+    by "parse_rows" so a line which is not UTF-8 only fails its row
+    """
+    buffer = b''
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+async def ingest(db: AsyncSession, rows: AsyncIterator[tuple], batch_size: int = 1000, hasher: Callable = None, on_insert: Callable = None, taken = None) -> IngestReport:
+    """
+    Imports parsed rows in batches of "batch_size". "hasher" is an async function
+    hashing a list of passwords (they are hashed inline otherwise), "on_insert"
+    is called with the influencers created by every batch and "taken" is a
+    TakenFilter skipping the lookups of emails and usernames known to be free
+    """
+    report = IngestReport()
+    batch = []
+    async for number, row in rows:
+        report.rows += 1
+        if isinstance(row, str):
+            report.error(number, row)
+            continue
+        try:
+            batch.append((number, BulkRow(**row)))
+        except (ValidationError, TypeError) as e:
+            report.error(number, str(e).replace('\n', ' '))
+            continue
+        if len(batch) >= batch_size:
+            await write_batch(db, batch, report, hasher, on_insert, taken)
+            batch = []
+    if batch:
+        await write_batch(db, batch, report, hasher, on_insert, taken)
+    return report
+
+
+async def write_batch(db: AsyncSession, batch: List[tuple], report: IngestReport, hasher: Callable = None, on_insert: Callable = None, taken = None) -> None:
+    """
+    Checks a batch of rows for conflicts with one query per unique column and
+    inserts the rest with multi-row INSERTs
+    """
+    # Normalizing emails and dropping rows repeating an email or username of the batch
+    rows, emails, usernames = [], set(), set()
+    for number, row in batch:
+        row.email = row.email.lower()
+        if row.email in emails or row.username in usernames:
+            report.error(number, 'Duplicate email or username in the import')
+            continue
+        emails.add(row.email)
+        usernames.add(row.username)
+        rows.append((number, row))
+
+    # Looking up which emails and usernames are already taken, apart from the ones the filter knows are free
+    if taken:
+        emails = {email for email in emails if taken.may_have_email(email)}
+        usernames = {username for username in usernames if taken.may_have_username(username)}
+    taken_emails = set((await db.execute(select(User.email).filter(User.email.in_(emails)))).scalars().all()) if emails else set()
+    taken_usernames = set((await db.execute(select(Influencer.username).filter(Influencer.username.in_(usernames)))).scalars().all()) if usernames else set()
+    # Ending the transaction of the lookups, so no connection is held while the passwords are hashed
+    await db.rollback()
+    accepted = []
+    for number, row in rows:
+        if row.email in taken_emails:
+            report.error(number, f'A user already exists with the email {row.email}')
+        elif row.username in taken_usernames:
+            report.error(number, 'An influencer with this username has already been recorded')
+        else:
+            accepted.append((number, row))
+    if not accepted:
+        return
+
+    # Hashing the plain passwords of the batch
+    plain = [row.password for _, row in accepted if not row.password_hash]
+    try:
+        hashes = iter(await hasher(plain) if hasher else hash_passwords(plain))
+    except PasswordPoolSaturated:
+        for number, _ in accepted:
+            report.error(number, 'Server is busy hashing passwords, please retry the row')
+        return
+    for _, row in accepted:
+        if not row.password_hash:
+            row.password_hash = next(hashes)
+
+    inserted = [row for _, row in accepted]
+    try:
+        await insert_rows(db, inserted)
+        await db.commit()
+    except IntegrityError:
+        # Another writer took an email or username since the check, inserting
+        # the rows one at a time to find out which
+        await db.rollback()
+        inserted = []
+        for number, row in accepted:
+            try:
+                await insert_rows(db, [row])
+                await db.commit()
+                inserted.append(row)
+            except IntegrityError:
+                await db.rollback()
+                report.error(number, 'Email or username already taken')
+    report.inserted += len(inserted)
+    if taken:
+        for row in inserted:
+            taken.add_email(row.email)
+            taken.add_username(row.username)
+
+    if on_insert and inserted:
+        influencers = (await db.execute(select(Influencer).filter(Influencer.username.in_([row.username for row in inserted])))).scalars().all()
+        on_insert(influencers)
+
+
+async def insert_rows(db: AsyncSession, rows: List[BulkRow]) -> None:
+    """
+    Inserts users and their influencer profiles with one multi-row INSERT each
+    """
+    await db.execute(insert(User), [{'email': row.email, 'password': row.password_hash} for row in rows])
+    user_ids = dict((await db.execute(select(User.email, User.id).filter(User.email.in_([row.email for row in rows])))).all())
+    await db.execute(insert(Influencer), [
+        {'user_id': user_ids[row.email], 'username': row.username, 'follower_count': row.follower_count, 'bio': row.bio}
+        for row in rows
+    ])
+
+
+async def read_file(path: str) -> AsyncIterator[bytes]:
+    with (sys.stdin.buffer if path == '-' else open(path, 'rb')) as lines:
+        for line in lines:
+            yield line.rstrip(b'\n')
+
+
+async def main(args: Iterable[str] = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Bulk import influencers from NDJSON or CSV')
+    parser.add_argument('path', help = 'File to import, "-" reads from stdin')
+    parser.add_argument('--format', choices = ['ndjson', 'csv'], help = 'Defaults to the file extension')
+    parser.add_argument('--batch-size', type = int, default = 1000)
+    args = parser.parse_args(args)
+
+    format = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+
+    async with AsyncSessionLocal() as db:
+        report = await ingest(db, parse_rows(read_file(args.path), format), args.batch_size)
+    print(json.dumps(report.dict(), indent = 2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
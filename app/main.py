@@ -1,30 +1,74 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Response, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Response, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 
 from typing import Optional
 
-from sqlalchemy.orm import Session
+import asyncio
+import logging
+import os
+import secrets
+import time
+
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from datetime import timedelta
 
-from .schemas import RegisterIn, OnBoardIn
+from .schemas import RegisterIn, OnBoardIn, UserResponse, LoginResponse, InfluencerResponse, SearchResponse
 
 from .models import User, Influencer
 
-from .utils import hash_password, compare_password
+from .utils import hash_password_async, compare_password_async, needs_rehash, PasswordPoolSaturated
+
+from .ingest import ingest, parse_rows, iter_lines, hash_passwords_pooled
+
+from .writes import OnboardingWriter, OnboardingConflict
+
+from .search import filter_influencers, paginate_influencers, rank_influencers, encode_cursor, count_influencers, stream_influencers, SEARCH_COLUMNS
+
+from .search_index import search_index
+
+from .search_pool import search_pool
+
+from .snapshot import search_snapshot
 
-from .database import get_db
+from .cache import search_cache
+
+from .bloom import taken_filter
+
+from .fuzzy import username_index, fuzzy_from_index, fuzzy_from_db
+
+from .changes import change_feed, table_version
+
+from .facets import follower_summary, histogram_from_db, histogram_from_index, log_buckets, bucket_ranges
+
+from .database import get_db, get_read_db, read_your_writes, prewarm, AsyncSessionLocal, get_async_engine, get_replica_engines, get_replica_router
 
 from .config import settings
 
-from .auth import AuthJWT, authenticate
+from .auth import AuthJWT, authenticate, user_registry
+
+from .ratelimit import login_rate_limit, register_rate_limit
+
+from .metrics import MetricsMiddleware, SamplingProfiler, registry, timed
+
+from .encoding import FastJSONResponse, dumps, accepted_encoding, compress, etag, etag_matches
+
+from .readiness import readiness
+
+logger = logging.getLogger(__name__)
 
 # Setting constants for Token expiry
 ACCESS_TOKEN_EXPIRES_IN = settings.ACCESS_TOKEN_EXPIRES_IN
 REFRESH_TOKEN_EXPIRES_IN = settings.REFRESH_TOKEN_EXPIRES_IN
 
 # Declaring app
-app = FastAPI()
+app = FastAPI(default_response_class = FastJSONResponse)
 
 # CORS Middlewares
 app.add_middleware(
@@ -35,80 +79,285 @@ app.add_middleware(
     allow_headers = ["*"]
 )
 
-@app.post("/register")
-async def register(data: RegisterIn, response: Response, db: Session = Depends(get_db)):
+# Write pipeline batching onboarding inserts
+onboarding_writer = OnboardingWriter(settings.ONBOARDING_BATCH_WINDOW_MS / 1000, settings.ONBOARDING_MAX_BATCH)
+
+# Metrics middleware, sampling slow requests if enabled. The engines time their SQL
+# statements themselves once they are created
+profiler = SamplingProfiler(settings.PROFILE_INTERVAL_MS / 1000, settings.PROFILE_DIR) if settings.PROFILE_SLOW_REQUEST_MS > 0 else None
+app.add_middleware(MetricsMiddleware, profiler = profiler, slow_request_seconds = settings.PROFILE_SLOW_REQUEST_MS / 1000)
+
+@app.exception_handler(PasswordPoolSaturated)
+async def password_pool_saturated(request: Request, exc: PasswordPoolSaturated):
+    """
+    Returns a 503 response asking the client to retry when too many passwords are being hashed
+    """
+    return JSONResponse(status_code = status.HTTP_503_SERVICE_UNAVAILABLE, content = {'detail': 'Server is busy, please retry shortly'}, headers = {'Retry-After': '1'})
+
+
+async def prewarm_pools():
+    """
+    Opens the connections of the primary and replica pools before the first requests come in.
+    Only failing to reach the primary stops the startup, replicas which can not be reached
+    are logged and skipped by reads until they are retried
+    """
+    replicas = get_replica_engines()
+    primary, *results = await asyncio.gather(*(prewarm(pool_engine, settings.DB_POOL_PREWARM) for pool_engine in [get_async_engine()] + replicas), return_exceptions = True)
+    for replica, result in zip(replicas, results):
+        if isinstance(result, Exception):
+            logger.error('Could not connect to the replica %s', replica.url, exc_info = result)
+            get_replica_router().mark_down(replica)
+    if isinstance(primary, BaseException):
+        raise primary
+
+
+async def load_follower_summary():
+    """
+    Loads the follower counts used to answer histograms
+    """
+    async with AsyncSessionLocal() as db:
+        await follower_summary.load(db)
+
+
+async def load_taken_filter():
+    """
+    Loads the emails and usernames in use into the uniqueness filters
+    """
+    async with AsyncSessionLocal() as db:
+        await taken_filter.load(db)
+
+
+async def load_username_index():
+    """
+    Loads the usernames searched by fuzzy searches
+    """
+    async with AsyncSessionLocal() as db:
+        await username_index.load(db)
+
+
+async def build_search_index():
+    """
+    Builds the in-process search index from the influencers table
+    """
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(search_index.build)
+
+
+async def load_search_snapshot():
+    """
+    Maps the saved snapshot of the influencers when it is recent enough and adds the
+    influencers created or updated since, takes a new snapshot otherwise (saved for the
+    other workers when a path is set) or when the file has an older format
+    """
+    path = settings.SEARCH_SNAPSHOT_PATH
+    async with AsyncSessionLocal() as db:
+        opened = False
+        if path and os.path.exists(path) and time.time() - os.path.getmtime(path) < settings.SEARCH_SNAPSHOT_MAX_AGE:
+            try:
+                search_snapshot.open(path)
+                opened = True
+            except ValueError:
+                logger.warning('Taking a new snapshot in place of %s', path)
+        if opened:
+            await db.run_sync(search_snapshot.catch_up, settings.CHANGE_FEED_LOOKBACK)
+        else:
+            await db.run_sync(search_snapshot.build)
+            if path:
+                search_snapshot.save(path)
+                search_snapshot.open(path)
+
+
+def apply_influencers(influencers):
+    """
+    Brings the in-memory state up to date with new or updated influencers
+    (Influencers or dicts of their columns), written by this process or
+    delivered by the change feed. Applying the same influencer again changes nothing
+    """
+    influencers = [influencer if isinstance(influencer, dict) else {column.name: getattr(influencer, column.name) for column in SEARCH_COLUMNS} for influencer in influencers]
+    for influencer in influencers:
+        user_registry.add(influencer['user_id'])
+        follower_summary.add(influencer['id'], influencer['follower_count'])
+        taken_filter.add_username(influencer['username'])
+        username_index.add(influencer['id'], influencer['username'])
+        if search_index.ready:
+            search_index.add(influencer)
+        if search_snapshot.ready:
+            search_snapshot.add(influencer)
+        if search_pool.ready:
+            search_pool.add(influencer)
+    # Cached searches may be missing the influencers or show their old values, and the
+    # version tagging search responses moves on
+    search_cache.invalidate()
+    change_feed.observe(influencers)
+
+
+change_feed.subscribe(apply_influencers)
+
+
+def memory_index():
+    """
+    In-memory structure answering searches, the snapshot when it is loaded and the search index otherwise
+    """
+    return search_snapshot if search_snapshot.ready else search_index
+
+
+async def search_version(db) -> str:
+    """
+    Version of the influencers searches are answered from. The change feed's
+    one costs nothing and is used when it follows what is searched (the
+    in-memory state, or the primary when there are no replicas), a lagging
+    replica is asked for its own version
+    """
+    if change_feed.task and (search_pool.ready or memory_index().ready or not get_replica_engines()):
+        return change_feed.version()
+    return await table_version(db)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Creates the engines and warms the pools and the in-memory state up before
+    serving, then stops the background work on shutdown. Nothing of this is done
+    when the app is only imported
+    """
+    # Sampling the event loop thread when the profiler is enabled
+    if profiler:
+        profiler.start()
+
+    # The change feed starts from the table as it is before the in-memory state is loaded,
+    # so nothing written while loading is missed
+    if settings.CHANGE_FEED != 'off':
+        await readiness.run('change_feed', change_feed.prime(settings.CHANGE_FEED_LOOKBACK))
+
+    # Warming up independent steps concurrently
+    steps = [readiness.run('pools', prewarm_pools())]
+    if settings.FOLLOWER_SUMMARY:
+        steps.append(readiness.run('follower_summary', load_follower_summary()))
+    if settings.UNIQUENESS_FILTER:
+        steps.append(readiness.run('taken_filter', load_taken_filter()))
+    if settings.FUZZY_SEARCH:
+        steps.append(readiness.run('username_index', load_username_index()))
+    if settings.SEARCH_ENGINE == 'index':
+        steps.append(readiness.run('search_index', build_search_index()))
+    if settings.SEARCH_ENGINE == 'snapshot':
+        steps.append(readiness.run('search_snapshot', load_search_snapshot()))
+    if settings.SEARCH_ENGINE == 'sharded':
+        steps.append(readiness.run('search_pool', search_pool.start(settings.SEARCH_WORKERS)))
+    await asyncio.gather(*steps)
+    if settings.CHANGE_FEED != 'off':
+        change_feed.start(settings.CHANGE_FEED, settings.DB_URL, settings.CHANGE_FEED_INTERVAL)
+    readiness.mark_ready()
+
+    yield
+
+    readiness.mark_not_ready()
+    change_feed.stop()
+    search_pool.stop()
+    search_snapshot.close()
+    if profiler:
+        profiler.stop()
+
+
+# FastAPI does not take a lifespan yet, so it is set on its router
+app.router.lifespan_context = lifespan
+
+
+@app.post("/register", response_model = UserResponse, dependencies = [Depends(register_rate_limit)])
+async def register(data: RegisterIn, response: Response, db: AsyncSession = Depends(get_db)):
     """
     Endpoint to register a new user collecting email and
     password
     """
     # Setting email to always be lower case
     data.email = data.email.lower()
-    # Checking if user already exists and returning appropriate error
-    user = db.query(User).filter(User.email == data.email).first()
-    if user:
-        raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = f"A user already exists with the email {data.email}")
+    # Checking if user already exists and returning appropriate error, emails the filter
+    # knows are free skip the lookup and only rely on the unique constraint
+    taken_error = HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = f"A user already exists with the email {data.email}")
+    if taken_filter.may_have_email(data.email):
+        user = (await db.execute(select(User.id).filter(User.email == data.email))).first()
+        if user:
+            raise taken_error
     # Create a new user and save to DB
-    new_user = User(email = data.email, password = hash_password(data.password))
+    new_user = User(email = data.email, password = await hash_password_async(data.password))
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    del new_user.password
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise taken_error
+    await db.refresh(new_user)
+    taken_filter.add_email(new_user.email)
+    user_registry.add(new_user.id)
+    # Reading from the primary for a while so the new user can log in before replicas catch up
+    read_your_writes(response)
     # Response Handling
     response.status_code = status.HTTP_201_CREATED
     return {'status': 'success', 'data': new_user}
 
 
-@app.post("/login")
-async def login(data: RegisterIn, response: Response, db: Session = Depends(get_db), Auth: AuthJWT = Depends()):
+@app.post("/login", response_model = LoginResponse, dependencies = [Depends(login_rate_limit)])
+async def login(data: RegisterIn, response: Response, db: AsyncSession = Depends(get_read_db), Auth: AuthJWT = Depends()):
     """
     Route to login users
     """
     # Finding user by email
-    user = db.query(User).filter(User.email == data.email.lower()).first()
+    user = (await db.execute(select(User).filter(User.email == data.email.lower()))).scalars().first()
     # Return error if user does not exist or password is incorrect
-    if (not user) or (not compare_password(data.password, user.password)):
+    if (not user) or (not await compare_password_async(data.password, user.password)):
         raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail = 'Incorrect email or password')
 
+    # Upgrading the hash if the cost factor changed since it was made, the login
+    # still succeeds if the password pool is too busy to do it now
+    if needs_rehash(user.password):
+        try:
+            password = await hash_password_async(data.password)
+            # The user was read from a replica, so the new hash is written on the primary
+            async with AsyncSessionLocal() as primary:
+                await primary.execute(update(User).filter(User.id == user.id).values(password = password))
+                await primary.commit()
+        except PasswordPoolSaturated:
+            pass
+
     # Creating tokens
-    access_token = Auth.create_access_token(subject = str(user.id), expires_time = timedelta(minutes = ACCESS_TOKEN_EXPIRES_IN))
-    refresh_token = Auth.create_refresh_token(subject = str(user.id), expires_time = timedelta(minutes = REFRESH_TOKEN_EXPIRES_IN))
+    with timed('jwt'):
+        access_token = Auth.create_access_token(subject = str(user.id), expires_time = timedelta(minutes = ACCESS_TOKEN_EXPIRES_IN))
+        refresh_token = Auth.create_refresh_token(subject = str(user.id), expires_time = timedelta(minutes = REFRESH_TOKEN_EXPIRES_IN))
 
     # Setting cookies with tokens created
     response.set_cookie('access_token', access_token, ACCESS_TOKEN_EXPIRES_IN * 60, ACCESS_TOKEN_EXPIRES_IN * 60, '/', None, False, True, 'lax')
     response.set_cookie('refresh_token', refresh_token, REFRESH_TOKEN_EXPIRES_IN * 60, REFRESH_TOKEN_EXPIRES_IN * 60, '/', None, False, True, 'lax')
 
-    # Stripping user to be returned of the password as it is sensitive
-    del user.password
-
     # Response Handling
     response.status_code = status.HTTP_200_OK
     return {'status': 'success', 'access_token': access_token, 'refresh_token': refresh_token, 'data': user}
 
 
 @app.get('/refresh')
-async def refresh_token(response: Response, request: Request, Auth: AuthJWT = Depends(), db: Session = Depends(get_db)):
+async def refresh_token(response: Response, request: Request, Auth: AuthJWT = Depends(), db: AsyncSession = Depends(get_read_db)):
     """
     Route to handle refreshing of tokens
     """
     # Try to get refresh token and create new access token based on this
     try:
-        # Getting refresh token from request
-        Auth.jwt_refresh_token_required()
-
-        # Getting jwt subject(user_id) from token
-        user_id = Auth.get_jwt_subject()
+        # Getting refresh token from request and the jwt subject(user_id) from the token
+        with timed('jwt'):
+            Auth.jwt_refresh_token_required()
+            user_id = Auth.get_jwt_subject()
 
         # Return a bad response if user_id does not exist
         if not user_id:
             raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail = 'Could not refresh access token')
         
-        # Fetching the user from DB and returning a nad response if user does not exist
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
+        # Making sure the user still exists and returning a bad response if it does not
+        if not await user_registry.exists(db, int(user_id)):
             raise HTTPException(status_code = status.HTTP_401_UNAUTHORIZED, detail = "User account deleted recently")
 
         # Creating new access token
-        access_token = Auth.create_access_token(subject = str(user.id), expires_time = timedelta(minutes = ACCESS_TOKEN_EXPIRES_IN))
+        with timed('jwt'):
+            access_token = Auth.create_access_token(subject = str(user_id), expires_time = timedelta(minutes = ACCESS_TOKEN_EXPIRES_IN))
+    # Passing the bad responses above on as they are
+    except HTTPException:
+        raise
     # If try block fails return a bad response with name of error
     except Exception as e:
         raise HTTPException(status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, detail = e.__class__.__name__)
@@ -132,57 +381,281 @@ async def logout(response: Response, Auth: AuthJWT = Depends()):
     return {'status': 'success'}
 
 
-@app.post('/onboarding')
-async def onboard_influencer(data: OnBoardIn, response: Response, db: Session = Depends(get_db), user_id = Depends(authenticate)):
+@app.post('/onboarding', response_model = InfluencerResponse)
+async def onboard_influencer(data: OnBoardIn, response: Response, user_id = Depends(authenticate)):
     """
     Route to onboard(collect info) for an influencer who is already an authenticated user
     """
-    # Return a bad response if there is already an influencer with this username
-    influencer = db.query(Influencer).filter(Influencer.username == data.username).first()
-    if influencer:
-        raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = "An influencer with this username has already been recorded")
-
-    # Return a bad response if user is already an influencer
-    existing_influencer = db.query(Influencer).filter(Influencer.user_id == user_id).first()
-    if existing_influencer:
-        raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = "This user is already an influencer")
+    # Inserting the new influencer through the write pipeline, the unique constraints
+    # on username and user_id turn into bad responses
+    try:
+        new_influencer = await onboarding_writer.insert({'user_id': user_id, **data.dict()})
+    except OnboardingConflict as e:
+        raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = e.detail)
 
-    # Creating new influencer with data given and adding to the db
-    new_influencer = Influencer(user_id = user_id, **data.dict())
-    db.add(new_influencer)
-    db.commit()
-    db.refresh(new_influencer)
+    # Keeping the in-memory state up to date with the new influencer right away, the
+    # change feed brings it to the other processes
+    apply_influencers([new_influencer])
+    # Reading from the primary for a while so the new influencer shows up in the user's searches
+    read_your_writes(response)
 
     # Handling response
     response.status_code = status.HTTP_201_CREATED
     return {'status': 'success', 'data': new_influencer}
 
 
-@app.get('/search')
-async def search_influencers(response: Response, db: Session = Depends(get_db), keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None):
+@app.post('/influencers/bulk')
+async def bulk_import_influencers(request: Request, response: Response, db: AsyncSession = Depends(get_db), format: Optional[str] = Query(None, regex = '^(ndjson|csv)$'), batch_size: int = Query(1000, ge = 1, le = 10000)):
+    """
+    Endpoint to import users and their influencer profiles in bulk from an
+    NDJSON or CSV body, rows which fail are reported without stopping the import
+    """
+    # Only callers holding the import token may use this endpoint
+    token = request.headers.get('X-Import-Token', '')
+    if not settings.BULK_IMPORT_TOKEN or not secrets.compare_digest(token, settings.BULK_IMPORT_TOKEN):
+        raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail = "Invalid import token")
+
+    # Picking the format from the content type if it was not given
+    if not format:
+        format = 'csv' if 'csv' in request.headers.get('Content-Type', '') else 'ndjson'
+
+    # Streaming the body through the import so it is never held in memory as a whole
+    rows = parse_rows(iter_lines(request.stream()), format)
+    report = await ingest(db, rows, batch_size, hasher = hash_passwords_pooled, on_insert = apply_influencers, taken = taken_filter)
+
+    # Handling response
+    response.status_code = status.HTTP_200_OK
+    return {'status': 'success', 'data': report.dict()}
+
+
+@app.get('/search', response_model = SearchResponse)
+async def search_influencers(request: Request, db: AsyncSession = Depends(get_read_db), keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None, limit: int = Query(settings.SEARCH_DEFAULT_LIMIT, ge = 1, le = settings.SEARCH_MAX_LIMIT), cursor: Optional[str] = None, total: Optional[str] = Query(None, regex = '^(exact|estimated)$'), sort: str = Query('followers', regex = '^(followers|relevance)$')):
     """
-    Endpoint to search for influencers based on some parameters
+    Endpoint to search for influencers based on some parameters, results are
+    ordered by follower count and paged with the "cursor" of the previous page.
+    With "sort=relevance" only the "limit" best matches of the keyword are returned.
+    Responses are tagged with the version of the influencers so clients repeating
+    a search get a 304 until an influencer is onboarded or updated
     """
-    # Fetch all influencers from the DB at first
-    all_influencers = db.query(Influencer).all()
-    
-    # Filter the list of influencers based on maximum amount of followers if the "max_followers" query parameter exists
-    if max_followers:
-        all_influencers = [influencer for influencer in all_influencers if influencer.follower_count <= max_followers]
-    
-    # Filter the list of influencers based on minimum amount of followers if the "min_followers" query parameter exists
-    if min_followers:
-        all_influencers = [influencer for influencer in all_influencers if influencer.follower_count >= min_followers]
+    # Relevance only applies to keyword searches and returns a single page
+    ranked = sort == 'relevance' and bool(keyword)
+    if ranked and cursor:
+        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "Cursors can not be used when sorting by relevance")
+
+    # Answering a repeated search before anything is searched or encoded
+    encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+    cache_key = search_cache.key(keyword, min_followers, max_followers, limit, cursor, total, ranked, encoding, await search_version(db))
+    headers = {'ETag': etag(*cache_key[1:]), 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+        return Response(status_code = status.HTTP_304_NOT_MODIFIED, headers = headers)
+
+    # Serving hot searches from the cache
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return search_response(*cached, headers)
+
+    try:
+        all_influencers, next_cursor = await without_dead_workers(search_page, db, keyword, min_followers, max_followers, limit, cursor, ranked)
+    except ValueError:
+        raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "Invalid cursor")
 
-    # Using the keyword to search bios and usernames of influencers
+    result = {'status': 'success', 'count': len(all_influencers), 'next_cursor': next_cursor, 'data': all_influencers}
+
+    # Only pay for counting all matches when the client asks for it
+    if total:
+        result['total'] = await without_dead_workers(search_total, db, keyword, min_followers, max_followers, total)
+
+    # Encoding the plain rows straight to JSON, skipping validation against the response
+    # model, and caching the encoded (and compressed) body so hits are served as is
+    with timed('serialization'):
+        body, content_encoding = compress(dumps(result), encoding, settings.SEARCH_COMPRESS_MIN_SIZE)
+    search_cache.set(cache_key, (body, content_encoding))
+
+    # Handling response
+    return search_response(body, content_encoding, headers)
+
+
+async def without_dead_workers(search, *args):
+    """
+    Runs a search, once more when a worker of the search pool died meanwhile as
+    the pool then stopped being ready and the search goes to another engine
+    """
+    try:
+        return await search(*args)
+    except BrokenProcessPool:
+        return await search(*args)
+
+
+async def search_page(db: AsyncSession, keyword: Optional[str], min_followers: Optional[int], max_followers: Optional[int], limit: int, cursor: Optional[str], ranked: bool) -> tuple:
+    """
+    Returns a page of influencers and the cursor to the next one from the search
+    pool, the in-memory index or the database, whichever is ready. Raises
+    ValueError for a malformed cursor
+    """
+    index = memory_index()
+    if ranked and search_pool.ready:
+        # Ranking the matches of every shard in parallel and merging their best ones
+        all_influencers, next_cursor = await search_pool.rank(db, keyword, min_followers, max_followers, limit), None
+    elif ranked and index.ready:
+        # Picking the best matches with a bounded heap over the index matches
+        all_influencers, next_cursor = index.rank(keyword, min_followers, max_followers, limit), None
+    elif ranked:
+        # Letting the database score the matches and keep the best ones
+        statement = filter_influencers(select(*SEARCH_COLUMNS), keyword, min_followers, max_followers)
+        all_influencers, next_cursor = [dict(row._mapping) for row in (await db.execute(rank_influencers(statement, keyword, limit))).all()], None
+    elif search_pool.ready:
+        # Filtering the shards in parallel worker processes, merging their pages and reading the rows of the result
+        all_influencers, next_cursor = await search_pool.search(db, keyword, min_followers, max_followers, limit, cursor)
+    elif index.ready:
+        # Answering from the in-process search index or snapshot
+        all_influencers, next_cursor = index.search(keyword, min_followers, max_followers, limit, cursor)
+    else:
+        # Let the database apply the follower range and keyword filters and seek to the requested page
+        # Only the columns of the response are selected, as plain rows instead of ORM instances
+        statement = filter_influencers(select(*SEARCH_COLUMNS), keyword, min_followers, max_followers)
+        rows = (await db.execute(paginate_influencers(statement, limit, cursor))).all()
+        all_influencers = [dict(row._mapping) for row in rows[:limit]]
+
+        # An extra row is fetched to know if there is a next page
+        next_cursor = None
+        if len(rows) > limit:
+            last = all_influencers[-1]
+            next_cursor = encode_cursor(last['follower_count'], last['id'])
+    return all_influencers, next_cursor
+
+
+async def search_total(db: AsyncSession, keyword: Optional[str], min_followers: Optional[int], max_followers: Optional[int], total: str) -> int:
+    """
+    Counts the influencers matching a search, estimated by the database when "total" is "estimated"
+    """
+    index = memory_index()
+    if search_pool.ready:
+        return await search_pool.count(keyword, min_followers, max_followers)
+    if index.ready:
+        return index.count(keyword, min_followers, max_followers)
+    return await count_influencers(db, keyword, min_followers, max_followers, exact = total == 'exact')
+
+
+def search_response(body: bytes, content_encoding: Optional[str], headers: dict) -> Response:
+    if content_encoding:
+        headers = dict(headers, **{'Content-Encoding': content_encoding})
+    return Response(body, status_code = status.HTTP_200_OK, media_type = 'application/json', headers = headers)
+
+
+@app.get('/usernames/availability')
+async def username_availability(username: str, db: AsyncSession = Depends(get_read_db)):
+    """
+    Endpoint to check if a username is still free for onboarding, answered by the
+    uniqueness filter when it knows the username is free and confirmed in the DB otherwise
+    """
+    available = True
+    if taken_filter.may_have_username(username):
+        available = (await db.execute(select(Influencer.id).filter(Influencer.username == username))).first() is None
+    return {'status': 'success', 'data': {'username': username, 'available': available}}
+
+
+@app.get('/search/fuzzy')
+async def fuzzy_search_influencers(username: str, db: AsyncSession = Depends(get_read_db), max_distance: int = Query(1, ge = 0, le = settings.FUZZY_MAX_DISTANCE), limit: int = Query(10, ge = 1, le = settings.SEARCH_MAX_LIMIT)):
+    """
+    Endpoint to find the influencers whose username is at most "max_distance"
+    typos (edits) away from "username", closest first and then by follower count.
+    Searches matching too many usernames (short ones for their distance) get a 400
+    """
+    # Serving repeated searches from the cache
+    cache_key = search_cache.key(username, None, None, 'fuzzy', max_distance, limit)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return Response(cached, media_type = 'application/json')
+
+    # Searching the in-memory index of usernames, or the trigram index on PostgreSQL
+    if username_index.ready:
+        try:
+            all_influencers = await fuzzy_from_index(db, username_index, username, max_distance, limit)
+        except ValueError as e:
+            raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = str(e))
+    elif db.bind.dialect.name == 'postgresql':
+        all_influencers = await fuzzy_from_db(db, username, max_distance, limit)
+    else:
+        raise HTTPException(status_code = status.HTTP_503_SERVICE_UNAVAILABLE, detail = "Fuzzy search is not available")
+
+    with timed('serialization'):
+        body = dumps({'status': 'success', 'count': len(all_influencers), 'data': all_influencers})
+    search_cache.set(cache_key, body)
+
+    # Handling response
+    return Response(body, status_code = status.HTTP_200_OK, media_type = 'application/json')
+
+
+@app.get('/influencers/histogram')
+async def follower_histogram(db: AsyncSession = Depends(get_read_db), keyword: Optional[str] = None, buckets: Optional[str] = None):
+    """
+    Endpoint to count influencers per follower count bucket, and the ones
+    matching the keyword if given. "buckets" is a comma separated list of the
+    lower bounds of the buckets, they are log scale (0, 1, 10, 100 ...) otherwise
+    """
+    # Parsing the bucket bounds
+    if buckets:
+        try:
+            bounds = sorted({int(bound) for bound in buckets.split(',')})
+        except ValueError:
+            raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "Buckets must be a comma separated list of numbers")
+        if len(bounds) > 100:
+            raise HTTPException(status_code = status.HTTP_400_BAD_REQUEST, detail = "At most 100 buckets can be requested")
+    else:
+        bounds = log_buckets()
+
+    # Counting every influencer from the in-memory summary when it is loaded
+    counts = follower_summary.histogram(bounds) if follower_summary.ready else await histogram_from_db(db, bounds)
+    data = bucket_ranges(bounds)
+    for bucket, count in zip(data, counts):
+        bucket['count'] = count
+
+    # Counting keyword matches in one pass over the matches
     if keyword:
-        all_influencers = [influencer for influencer in all_influencers if (influencer.bio and keyword.lower() in influencer.bio.lower()) or keyword.lower() in influencer.username.lower()]
+        if search_snapshot.ready:
+            matches = search_snapshot.histogram(bounds, keyword)
+        elif search_index.ready:
+            matches = histogram_from_index(search_index, bounds, keyword)
+        else:
+            matches = await histogram_from_db(db, bounds, keyword)
+        for bucket, count in zip(data, matches):
+            bucket['matches'] = count
 
     # Handling response
+    return {'status': 'success', 'data': data}
+
+
+@app.get('/search/cache')
+async def search_cache_stats(response: Response):
+    """
+    Endpoint to get hit/miss counters of the search cache, used to size it
+    """
     response.status_code = status.HTTP_200_OK
-    return {'status': 'success', 'count': len(all_influencers), 'data': all_influencers}
+    return {'status': 'success', 'data': search_cache.stats()}
 
 
-        
+@app.get('/search/stream')
+async def stream_search_influencers(keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None):
+    """
+    Endpoint to export every influencer matching the search parameters as NDJSON
+    (one influencer per line), ordered the same way as "/search"
+    """
+    return StreamingResponse(stream_influencers(keyword, min_followers, max_followers), media_type = 'application/x-ndjson')
 
-    
\ No newline at end of file
+
+@app.get('/ready')
+async def ready(response: Response):
+    """
+    Readiness probe, only succeeds once the pools and in-memory indexes are warm
+    and until the app starts shutting down
+    """
+    response.status_code = status.HTTP_200_OK if readiness.ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    return {'status': 'success' if readiness.ready else 'unavailable', 'data': readiness.status()}
+
+
+@app.get('/metrics')
+async def metrics():
+    """
+    Endpoint exposing per-route request metrics in the Prometheus text format
+    """
+    return PlainTextResponse(registry.render(), media_type = 'text/plain; version=0.0.4')
@@ -0,0 +1,337 @@
+"""
+Per-route request metrics exposed in the Prometheus text format.
+
+Every request gets a RequestMetrics object held in a context variable, the
+hot paths add the time they spend to it by phase (database queries through
+SQLAlchemy engine events, bcrypt, JWT and serialization) and the middleware
+adds it to the per-route totals once the response is sent. An opt-in sampling
+profiler dumps the stacks of slow requests in the folded format read by
+flamegraph.pl and speedscope.
+
+Connection pools are instrumented by subclassing their pool class, every
+checkout is timed and the pools' sizes are reported as gauges so the pool can
+be sized against the amount of worker processes.
+"""
+import os
+import sys
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+PHASES = ('pool', 'db', 'bcrypt', 'jwt', 'serialization')
+
+# Upper bounds (in seconds) of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds (in seconds) of the connection checkout wait histogram buckets
+POOL_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+
+class RequestMetrics:
+    """
+    Time spent by a single request in each phase and the amount of SQL statements it ran
+    """
+    __slots__ = ('phases', 'statements')
+
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.statements = 0
+
+
+current_request: ContextVar[Optional[RequestMetrics]] = ContextVar('current_request', default = None)
+
+
+@contextmanager
+def timed(phase: str):
+    """
+    Adds the time spent in the block to a phase of the current request
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current_request.get()
+        if metrics is not None:
+            metrics.phases[phase] += time.perf_counter() - start
+
+
+class RouteMetrics:
+    """
+    Totals of all requests to a route
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.statements = 0
+
+    def observe(self, seconds: float, metrics: RequestMetrics) -> None:
+        self.count += 1
+        self.seconds += seconds
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+        for phase, spent in metrics.phases.items():
+            self.phases[phase] += spent
+        self.statements += metrics.statements
+
+
+class PoolMetrics:
+    """
+    Checkouts of a connection pool, the time they waited for a connection and
+    how many gave up after the pool timeout
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.checkouts = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(POOL_BUCKETS)
+        self.timeouts = 0
+
+    def observe(self, pool, seconds: float, timed_out: bool) -> None:
+        # Keeping the latest pool, engines replace theirs when disposed
+        self.pool = pool
+        self.checkouts += 1
+        self.seconds += seconds
+        for index, bound in enumerate(POOL_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+        self.timeouts += timed_out
+
+    def gauges(self) -> Dict[str, float]:
+        """
+        Current size and usage of the pool, pools which keep no connections (e.g. NullPool) have none
+        """
+        if self.pool is None or not hasattr(self.pool, 'size'):
+            return {}
+        capacity = self.pool.size() + max(self.pool._max_overflow, 0)
+        checked_out = self.pool.checkedout()
+        return {
+            'size': self.pool.size(),
+            'capacity': capacity,
+            'idle': self.pool.checkedin(),
+            'checked_out': checked_out,
+            'saturation': checked_out / capacity if capacity else 0.0
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.routes: Dict[tuple, RouteMetrics] = {}
+        self.pools: Dict[str, PoolMetrics] = {}
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float, metrics: RequestMetrics) -> None:
+        key = (method, route, status_code)
+        if key not in self.routes:
+            self.routes[key] = RouteMetrics()
+        self.routes[key].observe(seconds, metrics)
+
+    def observe_checkout(self, pool, seconds: float, timed_out: bool) -> None:
+        name = getattr(pool, 'logging_name', None) or 'default'
+        if name not in self.pools:
+            self.pools[name] = PoolMetrics()
+        self.pools[name].observe(pool, seconds, timed_out)
+
+    def render(self) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format
+        """
+        lines = [
+            '# HELP http_request_duration_seconds Time taken to handle requests',
+            '# TYPE http_request_duration_seconds histogram'
+        ]
+        for (method, route, status_code), metrics in self.routes.items():
+            labels = f'method="{method}",route="{route}",status="{status_code}"'
+            for bound, count in zip(BUCKETS, metrics.buckets):
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {metrics.count}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {metrics.seconds}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {metrics.count}')
+
+        lines += [
+            '# HELP http_request_phase_seconds_total Time spent by requests in each phase',
+            '# TYPE http_request_phase_seconds_total counter'
+        ]
+        for (method, route, status_code), metrics in self.routes.items():
+            for phase, seconds in metrics.phases.items():
+                lines.append(f'http_request_phase_seconds_total{{method="{method}",route="{route}",status="{status_code}",phase="{phase}"}} {seconds}')
+
+        lines += [
+            '# HELP db_statements_total SQL statements run by requests',
+            '# TYPE db_statements_total counter'
+        ]
+        for (method, route, status_code), metrics in self.routes.items():
+            lines.append(f'db_statements_total{{method="{method}",route="{route}",status="{status_code}"}} {metrics.statements}')
+
+        lines += [
+            '# HELP db_pool_checkout_wait_seconds Time taken to check a connection out of the pool',
+            '# TYPE db_pool_checkout_wait_seconds histogram'
+        ]
+        for name, metrics in self.pools.items():
+            for bound, count in zip(POOL_BUCKETS, metrics.buckets):
+                lines.append(f'db_pool_checkout_wait_seconds_bucket{{pool="{name}",le="{bound}"}} {count}')
+            lines.append(f'db_pool_checkout_wait_seconds_bucket{{pool="{name}",le="+Inf"}} {metrics.checkouts}')
+            lines.append(f'db_pool_checkout_wait_seconds_sum{{pool="{name}"}} {metrics.seconds}')
+            lines.append(f'db_pool_checkout_wait_seconds_count{{pool="{name}"}} {metrics.checkouts}')
+
+        lines += [
+            '# HELP db_pool_checkout_timeouts_total Checkouts which gave up waiting for a connection',
+            '# TYPE db_pool_checkout_timeouts_total counter'
+        ]
+        for name, metrics in self.pools.items():
+            lines.append(f'db_pool_checkout_timeouts_total{{pool="{name}"}} {metrics.timeouts}')
+
+        lines += [
+            '# HELP db_pool_connections Connections of the pool, "saturation" is the share of its capacity checked out',
+            '# TYPE db_pool_connections gauge'
+        ]
+        for name, metrics in self.pools.items():
+            for state, value in metrics.gauges().items():
+                lines.append(f'db_pool_connections{{pool="{name}",state="{state}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def instrument_engine(engine) -> None:
+    """
+    Counts the statements run on a (sync) engine and adds their time to the
+    "db" phase of the current request
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        metrics = current_request.get()
+        if metrics is not None:
+            metrics.phases['db'] += time.perf_counter() - start
+            metrics.statements += 1
+
+
+_timed_pools = {}
+
+
+def timed_pool(pool_class):
+    """
+    Subclass of a pool class timing every checkout, the time goes to the
+    registry under the pool's logging name and to the "pool" phase of the
+    current request
+    """
+    if pool_class not in _timed_pools:
+        def connect(self):
+            start = time.perf_counter()
+            timed_out = False
+            try:
+                return pool_class.connect(self)
+            except PoolTimeout:
+                timed_out = True
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                registry.observe_checkout(self, seconds, timed_out)
+                metrics = current_request.get()
+                if metrics is not None:
+                    metrics.phases['pool'] += seconds
+
+        _timed_pools[pool_class] = type(f'Timed{pool_class.__name__}', (pool_class,), {'connect': connect})
+    return _timed_pools[pool_class]
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the event loop thread every "interval" seconds into a
+    ring buffer. Requests slower than the threshold dump the samples taken while
+    they ran, these also contain the stacks of requests running concurrently
+    """
+
+    def __init__(self, interval: float, directory: str, max_samples: int = 100000):
+        self.interval = interval
+        self.directory = directory
+        self.samples = deque(maxlen = max_samples)
+        self.thread_id = None
+        self.running = False
+
+    def start(self) -> None:
+        self.thread_id = threading.get_ident()
+        self.running = True
+        threading.Thread(target = self.sample, name = 'sampling-profiler', daemon = True).start()
+
+    def stop(self) -> None:
+        self.running = False
+
+    def sample(self) -> None:
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})')
+                frame = frame.f_back
+            self.samples.append((time.perf_counter(), ';'.join(reversed(stack))))
+            time.sleep(self.interval)
+
+    def dump(self, name: str, start: float, end: float) -> Optional[str]:
+        """
+        Writes the samples taken between "start" and "end" as folded stacks and returns the file path
+        """
+        counts = {}
+        for taken_at, stack in list(self.samples):
+            if start <= taken_at <= end:
+                counts[stack] = counts.get(stack, 0) + 1
+        if not counts:
+            return None
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(start * 1000) % 1000:03d}-{name}.folded")
+        with open(path, 'w') as output:
+            output.writelines(f'{stack} {count}\n' for stack, count in counts.items())
+        return path
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request and recording it against its route
+    """
+
+    def __init__(self, app, profiler: Optional[SamplingProfiler] = None, slow_request_seconds: float = 0):
+        self.app = app
+        self.profiler = profiler
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        metrics = RequestMetrics()
+        token = current_request.set(metrics)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            end = time.perf_counter()
+            current_request.reset(token)
+            # Requests which match no route are grouped together to keep the amount of series bounded
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            registry.observe(scope['method'], route, status_code, end - start, metrics)
+            if self.profiler and end - start >= self.slow_request_seconds:
+                self.profiler.dump(route.strip('/').replace('/', '_') or 'root', start, end)
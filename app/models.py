@@ -1,4 +1,4 @@
-from sqlalchemy import Column, DateTime, String, Integer, ForeignKey
+from sqlalchemy import Column, DateTime, String, Integer, ForeignKey, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -16,10 +16,22 @@ class User(Base):
 class Influencer(Base):
     __tablename__ = "influencers"
     id = Column(Integer, primary_key = True, index = True)
-    user_id = Column(Integer, ForeignKey('users.id', ondelete = 'CASCADE'), nullable = False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete = 'CASCADE'), unique = True, nullable = False)
     username = Column(String, unique = True, nullable = False)
     follower_count = Column(Integer, nullable = False)
     bio = Column(String)
     created_at = Column(DateTime(timezone=True), server_default = func.now())
     updated_at = Column(DateTime(timezone=True), onupdate = func.now())
-    user = relationship('User')
\ No newline at end of file
+    user = relationship('User')
+
+    # Index for the (follower_count, id) ordering used by keyset pagination of searches, it
+    # also serves follower_count range filters.
+    # Trigram indexes on the lower cased username and bio so keyword (substring) searches
+    # do not have to scan the whole table on PostgreSQL.
+    # Index on when a row last changed, polled by the change feed
+    __table_args__ = (
+        Index('ix_influencers_follower_count_id', follower_count, id),
+        Index('ix_influencers_changed_at', func.coalesce(updated_at, created_at)),
+        Index('ix_influencers_username_trgm', func.lower(username).label('username_lower'), postgresql_using = 'gin', postgresql_ops = {'username_lower': 'gin_trgm_ops'}),
+        Index('ix_influencers_bio_trgm', func.lower(bio).label('bio_lower'), postgresql_using = 'gin', postgresql_ops = {'bio_lower': 'gin_trgm_ops'}),
+    )
\ No newline at end of file
@@ -0,0 +1,104 @@
+import math
+import time
+
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from fastapi import HTTPException, Request, status
+
+from .config import settings
+
+
+class BucketStore:
+    """
+    Interface of the storage holding the token buckets of the rate limiter,
+    other backends (e.g. a shared one) only have to implement "take" atomically
+    """
+
+    def take(self, key: Hashable, rate: float, burst: int) -> float:
+        """
+        Takes a token from the bucket of "key", which holds up to "burst" tokens and
+        gains "rate" tokens per second. Returns 0 if a token was taken, otherwise
+        the seconds until the next one is available
+        """
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryBuckets(BucketStore):
+    """
+    In-memory backend keeping a (tokens, last update) pair per key. Only the
+    "max_keys" most recently used buckets are kept, an evicted bucket starts
+    full again which is the state it would have reached after being idle.
+    Only touched from the event loop, so no lock is needed
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def take(self, key: Hashable, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        self.buckets[key] = (tokens - 1, now)
+        self.buckets.move_to_end(key)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last = False)
+        return 0.0
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits of a route, keyed by client IP and by email. A
+    limit of 0 requests per minute disables it
+    """
+
+    def __init__(self, store: BucketStore, name: str, ip_per_minute: float, ip_burst: int, email_per_minute: float, email_burst: int):
+        self.store = store
+        self.name = name
+        self.limits = {'ip': (ip_per_minute / 60, ip_burst), 'email': (email_per_minute / 60, email_burst)}
+        self.rejected = 0
+
+    def check(self, ip: Optional[str], email: Optional[str]) -> float:
+        """
+        Takes a token for the IP and the email, returns 0 if the request may go
+        on and the seconds to wait otherwise
+        """
+        for kind, value in (('ip', ip), ('email', email)):
+            rate, burst = self.limits[kind]
+            if rate <= 0 or not value:
+                continue
+            wait = self.store.take((self.name, kind, value), rate, burst)
+            if wait:
+                self.rejected += 1
+                return wait
+        return 0.0
+
+    async def __call__(self, request: Request) -> None:
+        """
+        Dependency rejecting requests over the limits with a 429, it runs before the
+        route's other dependencies so refused requests never reach bcrypt or the DB
+        """
+        # The body was already read and parsed by FastAPI, so this does not read it again
+        try:
+            email = (await request.json()).get('email')
+        except (ValueError, AttributeError):
+            email = None
+        wait = self.check(request.client.host if request.client else None, email.lower() if isinstance(email, str) else None)
+        if wait:
+            raise HTTPException(status_code = status.HTTP_429_TOO_MANY_REQUESTS, detail = 'Too many attempts, please retry later', headers = {'Retry-After': str(math.ceil(wait))})
+
+
+buckets = MemoryBuckets(settings.RATE_LIMIT_MAX_KEYS)
+
+login_rate_limit = RateLimiter(buckets, 'login', settings.LOGIN_RATE_PER_IP, settings.LOGIN_BURST_PER_IP, settings.LOGIN_RATE_PER_EMAIL, settings.LOGIN_BURST_PER_EMAIL)
+
+register_rate_limit = RateLimiter(buckets, 'register', settings.REGISTER_RATE_PER_IP, settings.REGISTER_BURST_PER_IP, settings.REGISTER_RATE_PER_EMAIL, settings.REGISTER_BURST_PER_EMAIL)
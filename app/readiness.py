@@ -0,0 +1,38 @@
+import time
+
+from typing import Dict
+
+
+class Readiness:
+    """
+    Tracks the warm-up steps run at startup (opening the connection pools,
+    loading in-memory state and building the search index). The app is ready
+    once every step finished and stops being ready when it starts shutting down
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.started = time.perf_counter()
+        # Seconds every finished step took
+        self.steps: Dict[str, float] = {}
+
+    async def run(self, name: str, awaitable) -> None:
+        """
+        Awaits a warm-up step and records how long it took
+        """
+        start = time.perf_counter()
+        await awaitable
+        self.steps[name] = round(time.perf_counter() - start, 6)
+
+    def mark_ready(self) -> None:
+        self.ready = True
+        self.steps['total'] = round(time.perf_counter() - self.started, 6)
+
+    def mark_not_ready(self) -> None:
+        self.ready = False
+
+    def status(self) -> dict:
+        return {'ready': self.ready, 'steps': dict(self.steps)}
+
+
+readiness = Readiness()
@@ -1,5 +1,9 @@
+# EmailStr needs email-validator, importing it can not be deferred as fastapi itself
+# imports it (in fastapi.openapi.models) whenever it is installed
 from pydantic import BaseModel, EmailStr, constr
-from typing import Optional
+from typing import Optional, List
+
+from datetime import datetime
 
 class RegisterIn(BaseModel):
     email: EmailStr
@@ -9,4 +13,50 @@ class RegisterIn(BaseModel):
 class OnBoardIn(BaseModel):
     username: str
     follower_count: int
-    bio: Optional[constr(max_length = 100)] = None
\ No newline at end of file
+    bio: Optional[constr(max_length = 100)] = None
+
+
+class UserOut(BaseModel):
+    id: int
+    email: str
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+
+class InfluencerOut(BaseModel):
+    id: int
+    user_id: int
+    username: str
+    follower_count: int
+    bio: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+
+class UserResponse(BaseModel):
+    status: str
+    data: UserOut
+
+
+class LoginResponse(UserResponse):
+    access_token: str
+    refresh_token: str
+
+
+class InfluencerResponse(BaseModel):
+    status: str
+    data: InfluencerOut
+
+
+class SearchResponse(BaseModel):
+    status: str
+    count: int
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+    data: List[InfluencerOut]
\ No newline at end of file
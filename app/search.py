@@ -0,0 +1,189 @@
+import base64
+import binascii
+import json
+
+from typing import AsyncIterator, Optional, Tuple
+
+from sqlalchemy import case, func, literal, or_, select, tuple_
+
+from .database import AsyncSessionLocal
+from .encoding import dumps
+from .models import Influencer
+
+# Columns returned for every influencer found by a search, selected as plain rows
+# so results skip building ORM instances
+SEARCH_COLUMNS = tuple(Influencer.__table__.columns)
+
+# Relevance points of the ways a keyword can match an influencer, the username and bio
+# points are added up. A token match is the keyword as a whole space separated word
+USERNAME_EXACT_SCORE = 10
+USERNAME_TOKEN_SCORE = 6
+USERNAME_SUBSTRING_SCORE = 4
+BIO_TOKEN_SCORE = 3
+BIO_SUBSTRING_SCORE = 1
+# Influencers also get a point per digit of their follower count past the first (the
+# floor of its log10), capped at this many points
+MAX_FOLLOWER_SCORE = 9
+
+# Amount of rows fetched from the server-side cursor at a time when streaming
+STREAM_BATCH_SIZE = 1000
+
+
+def filter_influencers(query, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None):
+    """
+    Applies the search parameters to a query (or select statement) on influencers as SQL
+    WHERE clauses so the database does the filtering (using the
+    follower_count and trigram indexes) instead of python
+    """
+    # Filter based on maximum amount of followers if the "max_followers" parameter exists
+    if max_followers:
+        query = query.filter(Influencer.follower_count <= max_followers)
+
+    # Filter based on minimum amount of followers if the "min_followers" parameter exists
+    if min_followers:
+        query = query.filter(Influencer.follower_count >= min_followers)
+
+    # Using the keyword to search bios and usernames of influencers, wildcards in the keyword
+    # are escaped so it is matched as a plain substring
+    if keyword:
+        keyword = keyword.lower()
+        query = query.filter(or_(
+            func.lower(Influencer.bio).contains(keyword, autoescape = True),
+            func.lower(Influencer.username).contains(keyword, autoescape = True)
+        ))
+
+    return query
+
+
+def encode_cursor(follower_count: int, influencer_id: int) -> str:
+    """
+    Encodes the sort key of the last influencer on a page into an
+    opaque cursor string
+    """
+    raw = f"{follower_count}:{influencer_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    """
+    Decodes a cursor created by "encode_cursor", raises ValueError
+    if the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        follower_count, influencer_id = raw.split(':')
+        return int(follower_count), int(influencer_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def paginate_influencers(query, limit: int, cursor: Optional[str] = None):
+    """
+    Orders a query (or select statement) on influencers by (follower_count, id) descending and
+    seeks past the cursor so the database jumps straight to the page
+    (using the (follower_count, id) index) instead of using OFFSET.
+    One extra row is requested so callers can tell if there is a next page
+    """
+    if cursor:
+        query = query.filter(tuple_(Influencer.follower_count, Influencer.id) < tuple_(*decode_cursor(cursor)))
+    return query.order_by(Influencer.follower_count.desc(), Influencer.id.desc()).limit(limit + 1)
+
+
+def relevance_score(keyword: str, username: str, bio: Optional[str], follower_count: int) -> int:
+    """
+    Scores how well an influencer matches the lower cased keyword, the same
+    way as "relevance_expression" does in SQL
+    """
+    username = username.lower()
+    if username == keyword:
+        score = USERNAME_EXACT_SCORE
+    elif f' {keyword} ' in f' {username} ':
+        score = USERNAME_TOKEN_SCORE
+    elif keyword in username:
+        score = USERNAME_SUBSTRING_SCORE
+    else:
+        score = 0
+
+    if bio:
+        bio = bio.lower()
+        if f' {keyword} ' in f' {bio} ':
+            score += BIO_TOKEN_SCORE
+        elif keyword in bio:
+            score += BIO_SUBSTRING_SCORE
+
+    if follower_count > 0:
+        score += min(len(str(follower_count)) - 1, MAX_FOLLOWER_SCORE)
+    return score
+
+
+def relevance_expression(keyword: str):
+    """
+    SQL expression scoring how well an influencer matches the lower cased keyword
+    """
+    username = func.lower(Influencer.username)
+    bio = func.lower(Influencer.bio)
+    token = f' {keyword} '
+    username_score = case(
+        (username == keyword, USERNAME_EXACT_SCORE),
+        ((literal(' ') + username + literal(' ')).contains(token, autoescape = True), USERNAME_TOKEN_SCORE),
+        (username.contains(keyword, autoescape = True), USERNAME_SUBSTRING_SCORE),
+        else_ = 0
+    )
+    bio_score = case(
+        ((literal(' ') + bio + literal(' ')).contains(token, autoescape = True), BIO_TOKEN_SCORE),
+        (bio.contains(keyword, autoescape = True), BIO_SUBSTRING_SCORE),
+        else_ = 0
+    )
+    follower_score = case(
+        *[(Influencer.follower_count >= 10 ** digits, digits) for digits in range(MAX_FOLLOWER_SCORE, 0, -1)],
+        else_ = 0
+    )
+    return username_score + bio_score + follower_score
+
+
+def rank_influencers(query, keyword: str, limit: int):
+    """
+    Orders a query on influencers by relevance to the keyword and keeps the top
+    "limit" ones, with the LIMIT the database keeps a bounded top-N heap instead
+    of sorting every match
+    """
+    score = relevance_expression(keyword.lower())
+    return query.order_by(score.desc(), Influencer.follower_count.desc(), Influencer.id.desc()).limit(limit)
+
+
+async def count_influencers(db, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None, exact: bool = True) -> int:
+    """
+    Counts the influencers matching the search parameters. An estimate
+    taken from the PostgreSQL query planner is returned when "exact" is
+    False, other databases always get an exact count
+    """
+    if exact or db.bind.dialect.name != 'postgresql':
+        statement = filter_influencers(select(func.count(Influencer.id)), keyword, min_followers, max_followers)
+        return (await db.execute(statement)).scalar()
+
+    # Ask the planner for its row estimate rather than running the count
+    statement = filter_influencers(select(Influencer.id), keyword, min_followers, max_followers)
+    compiled = statement.compile(dialect = db.bind.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positional else compiled.params
+    connection = await db.connection()
+    plan = (await connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + str(compiled), params)).scalar()
+    # asyncpg hands JSON back as text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+async def stream_influencers(keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Yields every influencer matching the search parameters as a line of NDJSON.
+    Rows are read from a server-side cursor in batches and written as they are
+    fetched, so memory use does not grow with the amount of matches
+    """
+    statement = filter_influencers(select(*SEARCH_COLUMNS), keyword, min_followers, max_followers)
+    statement = statement.order_by(Influencer.follower_count.desc(), Influencer.id.desc()).execution_options(yield_per = STREAM_BATCH_SIZE)
+
+    # The stream outlives the request handler, so it gets a session of its own
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(statement)
+        async for rows in result.partitions():
+            yield b''.join(dumps(dict(row._mapping)) + b'\n' for row in rows)
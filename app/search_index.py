@@ -0,0 +1,243 @@
+import bisect
+import heapq
+
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .models import Influencer
+from .search import encode_cursor, decode_cursor, relevance_score
+
+# Length of the n-grams kept in the index. Longer keywords are looked up with their
+# n-grams and the candidates are then checked for the full substring, shorter ones
+# match too many influencers to be worth indexing and are checked one by one
+NGRAM_SIZE = 3
+
+# Postings this many times longer than the candidates left are probed with bisect
+# instead of being walked
+PROBE_RATIO = 16
+
+
+def ngrams(text: str) -> Set[str]:
+    """
+    Returns every substring of "text" NGRAM_SIZE characters long
+    """
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+def contains(posting: array, influencer_id: int) -> bool:
+    index = bisect.bisect_left(posting, influencer_id)
+    return index < len(posting) and posting[index] == influencer_id
+
+
+class SearchIndex:
+    """
+    In-process search engine over influencers. It keeps a trigram inverted
+    index over the lower cased usernames and bios, whose postings are sorted
+    arrays of ids, and the influencers sorted by (follower_count, id) so
+    follower ranges are found with bisect. Results are the same as the
+    substring search done by the database
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Empties the index
+        """
+        self.ready = False
+        self.documents: Dict[int, dict] = {}
+        self.grams: Dict[str, array] = {}
+        # Sort keys (follower_count, id) of all influencers in ascending order
+        self.keys: List[Tuple[int, int]] = []
+
+    def build(self, db) -> None:
+        """
+        (Re)builds the index from all influencers in the database
+        """
+        self.clear()
+        postings: Dict[str, List[int]] = {}
+        for influencer in db.query(Influencer).yield_per(1000):
+            document = self._document(influencer)
+            self.documents[document['id']] = document
+            for gram in self._grams(document):
+                postings.setdefault(gram, []).append(document['id'])
+            self.keys.append((influencer.follower_count, influencer.id))
+        # Sorting every posting once instead of inserting the ids in order
+        self.grams = {gram: array('q', sorted(ids)) for gram, ids in postings.items()}
+        self.keys.sort()
+        self.ready = True
+
+    def add(self, influencer) -> None:
+        """
+        Adds an influencer (an Influencer or a dict of its columns) to the index,
+        replacing the indexed one if it is already there
+        """
+        document = self._document(influencer)
+        previous = self.documents.get(document['id'])
+        if previous == document:
+            return
+        if previous is not None:
+            self.remove(document['id'])
+        self._index(document)
+        bisect.insort(self.keys, (document['follower_count'], document['id']))
+
+    def remove(self, influencer_id: int) -> None:
+        """
+        Takes an influencer out of the index
+        """
+        document = self.documents.pop(influencer_id)
+        for gram in self._grams(document):
+            posting = self.grams[gram]
+            del posting[bisect.bisect_left(posting, influencer_id)]
+            if not posting:
+                del self.grams[gram]
+        del self.keys[bisect.bisect_left(self.keys, (document['follower_count'], influencer_id))]
+
+    @staticmethod
+    def _document(influencer) -> dict:
+        if isinstance(influencer, dict):
+            return {column.name: influencer[column.name] for column in Influencer.__table__.columns}
+        return {column.name: getattr(influencer, column.name) for column in Influencer.__table__.columns}
+
+    @staticmethod
+    def _texts(document: dict) -> List[str]:
+        """
+        Lower cased username and bio of an influencer
+        """
+        texts = [document['username'].lower()]
+        if document['bio']:
+            texts.append(document['bio'].lower())
+        return texts
+
+    def _grams(self, document: dict) -> Set[str]:
+        return set().union(*(ngrams(text) for text in self._texts(document)))
+
+    def _index(self, influencer) -> dict:
+        document = self._document(influencer)
+        self.documents[document['id']] = document
+
+        # Indexing the trigrams of the lower cased username and bio of the influencer
+        for gram in self._grams(document):
+            bisect.insort(self.grams.setdefault(gram, array('q')), document['id'])
+        return document
+
+    def matches(self, keyword: str) -> Iterable[int]:
+        """
+        Returns the ids of influencers whose username or bio contains the lower cased keyword
+        """
+        # Keywords shorter than the n-grams are checked against every influencer
+        if len(keyword) < NGRAM_SIZE:
+            return {influencer_id for influencer_id in self.documents if self._contains(influencer_id, keyword)}
+        # Keywords as long as the n-grams are answered by the index directly
+        if len(keyword) == NGRAM_SIZE:
+            return self.grams.get(keyword, array('q'))
+
+        # Intersecting the postings of the keyword's n-grams, starting from the rarest
+        postings = sorted((self.grams.get(gram, array('q')) for gram in ngrams(keyword)), key = len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            if len(posting) > PROBE_RATIO * len(candidates):
+                candidates = {influencer_id for influencer_id in candidates if contains(posting, influencer_id)}
+            else:
+                candidates.intersection_update(posting)
+
+        # Confirming the candidates really contain the keyword
+        return {influencer_id for influencer_id in candidates if self._contains(influencer_id, keyword)}
+
+    def _contains(self, influencer_id: int, keyword: str) -> bool:
+        document = self.documents[influencer_id]
+        return keyword in document['username'].lower() or bool(document['bio'] and keyword in document['bio'].lower())
+
+    def _range(self, min_followers: Optional[int], max_followers: Optional[int]) -> Tuple[int, int]:
+        """
+        Returns the slice of "keys" within the follower range
+        """
+        low = bisect.bisect_left(self.keys, (min_followers, -1)) if min_followers else 0
+        high = bisect.bisect_right(self.keys, (max_followers, float('inf'))) if max_followers else len(self.keys)
+        return low, high
+
+    def search(self, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None, limit: int = 50, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Returns a page of influencers matching the search parameters ordered by
+        (follower_count, id) descending and the cursor to the next page, the same
+        way the database search does. Raises ValueError for a malformed cursor
+        """
+        low, high = self._range(min_followers, max_followers)
+        # Skipping everything up to and including the cursor
+        if cursor:
+            high = min(high, bisect.bisect_left(self.keys, decode_cursor(cursor)))
+
+        if keyword and len(keyword) < NGRAM_SIZE:
+            # Short keywords match most influencers, walking the follower range down
+            # from the top and checking them until the page is full
+            keyword = keyword.lower()
+            page = []
+            for index in range(high - 1, low - 1, -1):
+                if self._contains(self.keys[index][1], keyword):
+                    page.append(self.keys[index])
+                    if len(page) > limit:
+                        break
+        elif keyword:
+            candidates = self.matches(keyword.lower())
+            if len(candidates) < high - low:
+                # Few matches, picking the largest keys among them
+                bounds = (self.keys[low], self.keys[high - 1]) if low < high else None
+                keys = [(self.documents[i]['follower_count'], i) for i in candidates]
+                page = heapq.nlargest(limit + 1, (key for key in keys if bounds and bounds[0] <= key <= bounds[1]))
+            else:
+                # Many matches, walking the follower range down from the top
+                if isinstance(candidates, set):
+                    found = candidates.__contains__
+                else:
+                    found = lambda influencer_id: contains(candidates, influencer_id)
+                page = []
+                for index in range(high - 1, low - 1, -1):
+                    if found(self.keys[index][1]):
+                        page.append(self.keys[index])
+                        if len(page) > limit:
+                            break
+        else:
+            page = self.keys[max(low, high - limit - 1):high][::-1]
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(*page[-1])
+        return [self.documents[influencer_id] for _, influencer_id in page], next_cursor
+
+    def rank(self, keyword: str, min_followers: Optional[int] = None, max_followers: Optional[int] = None, limit: int = 50) -> List[dict]:
+        """
+        Returns the "limit" influencers matching the search parameters which are most
+        relevant to the keyword, picked with a bounded heap instead of sorting all matches
+        """
+        keyword = keyword.lower()
+        low, high = self._range(min_followers, max_followers)
+        if low >= high:
+            return []
+        bounds = (self.keys[low], self.keys[high - 1])
+
+        def key(influencer_id):
+            document = self.documents[influencer_id]
+            score = relevance_score(keyword, document['username'], document['bio'], document['follower_count'])
+            return score, document['follower_count'], influencer_id
+
+        candidates = (i for i in self.matches(keyword) if bounds[0] <= (self.documents[i]['follower_count'], i) <= bounds[1])
+        return [self.documents[influencer_id] for influencer_id in heapq.nlargest(limit, candidates, key = key)]
+
+    def count(self, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None) -> int:
+        """
+        Counts the influencers matching the search parameters
+        """
+        low, high = self._range(min_followers, max_followers)
+        if not keyword:
+            return max(0, high - low)
+        if low >= high:
+            return 0
+        bounds = (self.keys[low], self.keys[high - 1])
+        return sum(1 for i in self.matches(keyword.lower()) if bounds[0] <= (self.documents[i]['follower_count'], i) <= bounds[1])
+
+
+search_index = SearchIndex()
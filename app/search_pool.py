@@ -0,0 +1,301 @@
+"""
+Multi-process search over influencers.
+
+The influencers are split into shards by id, every shard is held by its own
+worker process which loads it from the database and keeps only the columns
+searches filter on, in arrays and one text buffer. Searches are sent to every
+shard at once, the shards filter by keyword and follower range in parallel
+(each holding its own GIL) and return the keys of their matches, the API
+process merges them and reads the full rows of the final page by id, so search
+throughput grows with the cores.
+"""
+import asyncio
+import bisect
+import heapq
+import itertools
+import multiprocessing
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+
+from .models import Influencer
+from .search import SEARCH_COLUMNS, decode_cursor, encode_cursor, relevance_score
+
+# Columns the shards filter on, the rest of a row is read by id once the page is known
+FILTER_COLUMNS = (Influencer.id, Influencer.follower_count, Influencer.username, Influencer.bio)
+ID, FOLLOWER_COUNT, USERNAME, BIO = range(len(FILTER_COLUMNS))
+
+
+class Shard:
+    """
+    Influencers of a shard sorted by (follower_count, id), kept as the columns
+    searches filter on. Follower counts and ids are arrays to find follower
+    ranges with bisect, and the lower cased "username\\0bio" of every row is
+    stored UTF-8 encoded in one buffer, row i's text being
+    text[starts[i]:ends[i]]. The texts of added rows are appended to the
+    buffer, which is compacted once the texts of replaced rows take half of it.
+    The ids are also kept sorted along with their follower count to find the
+    row an update replaces
+    """
+
+    def __init__(self):
+        self.load([])
+
+    def load(self, rows: List[tuple]) -> None:
+        """
+        Replaces the shard with rows of the FILTER_COLUMNS
+        """
+        rows = sorted(rows, key = lambda row: (row[FOLLOWER_COUNT], row[ID]))
+        self.follower_counts = array('q', (row[FOLLOWER_COUNT] for row in rows))
+        self.ids = array('q', (row[ID] for row in rows))
+        self.text = bytearray()
+        self.starts, self.ends = array('q'), array('q')
+        for row in rows:
+            self.starts.append(len(self.text))
+            self.text += self._text(row)
+            self.ends.append(len(self.text))
+        # Size of the texts no row points to anymore
+        self.garbage = 0
+
+        by_id = sorted(rows, key = lambda row: row[ID])
+        self.sorted_ids = array('q', (row[ID] for row in by_id))
+        self.sorted_counts = array('q', (row[FOLLOWER_COUNT] for row in by_id))
+
+    def add(self, row: tuple) -> None:
+        """
+        Adds a row of the FILTER_COLUMNS or replaces the row of the same influencer
+        """
+        text = self._text(row)
+        position = bisect.bisect_left(self.sorted_ids, row[ID])
+        if position < len(self.sorted_ids) and self.sorted_ids[position] == row[ID]:
+            index = self._position(self.sorted_counts[position], row[ID])
+            if self.follower_counts[index] == row[FOLLOWER_COUNT] and self.text[self.starts[index]:self.ends[index]] == text:
+                return
+            self.garbage += self.ends[index] - self.starts[index]
+            for column in (self.follower_counts, self.ids, self.starts, self.ends):
+                del column[index]
+            self.sorted_counts[position] = row[FOLLOWER_COUNT]
+        else:
+            self.sorted_ids.insert(position, row[ID])
+            self.sorted_counts.insert(position, row[FOLLOWER_COUNT])
+
+        index = self._position(row[FOLLOWER_COUNT], row[ID])
+        self.follower_counts.insert(index, row[FOLLOWER_COUNT])
+        self.ids.insert(index, row[ID])
+        self.starts.insert(index, len(self.text))
+        self.text += text
+        self.ends.insert(index, len(self.text))
+        if self.garbage * 2 > len(self.text):
+            self._compact()
+
+    def _compact(self) -> None:
+        """
+        Copies the texts still in use to a new buffer in row order
+        """
+        text, starts, ends = bytearray(), array('q'), array('q')
+        for start, end in zip(self.starts, self.ends):
+            starts.append(len(text))
+            text += self.text[start:end]
+            ends.append(len(text))
+        self.text, self.starts, self.ends, self.garbage = text, starts, ends, 0
+
+    @staticmethod
+    def _text(row: tuple) -> bytes:
+        return f"{row[USERNAME]}\0{row[BIO] or ''}".lower().encode('utf-8')
+
+    def _matches(self, index: int, keyword: bytes) -> bool:
+        return self.text.find(keyword, self.starts[index], self.ends[index]) >= 0
+
+    def _position(self, follower_count: int, influencer_id: int) -> int:
+        """
+        Index of the first row with a key not below (follower_count, influencer_id)
+        """
+        low = bisect.bisect_left(self.follower_counts, follower_count)
+        high = bisect.bisect_right(self.follower_counts, follower_count, low)
+        return bisect.bisect_left(self.ids, influencer_id, low, high)
+
+    def _range(self, min_followers: Optional[int], max_followers: Optional[int], before: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+        """
+        Returns the slice of rows within the follower range and below the "before" key
+        """
+        low = bisect.bisect_left(self.follower_counts, min_followers) if min_followers else 0
+        high = bisect.bisect_right(self.follower_counts, max_followers) if max_followers else len(self.ids)
+        if before:
+            high = min(high, self._position(*before))
+        return low, high
+
+    def search(self, keyword: Optional[str], min_followers: Optional[int], max_followers: Optional[int], limit: int, before: Optional[Tuple[int, int]] = None) -> List[Tuple[int, int]]:
+        """
+        Returns the (follower_count, id) keys of up to "limit" rows matching the lower
+        cased keyword and the follower range, descending and starting below "before"
+        """
+        low, high = self._range(min_followers, max_followers, before)
+        encoded = keyword.encode('utf-8') if keyword else None
+        page = []
+        for index in range(high - 1, low - 1, -1):
+            if not encoded or self._matches(index, encoded):
+                page.append((self.follower_counts[index], self.ids[index]))
+                if len(page) >= limit:
+                    break
+        return page
+
+    def rank(self, keyword: str, min_followers: Optional[int], max_followers: Optional[int], limit: int) -> List[Tuple[int, int, int]]:
+        """
+        Returns the "limit" rows most relevant to the lower cased keyword as
+        (score, follower_count, id) triples
+        """
+        low, high = self._range(min_followers, max_followers)
+        encoded = keyword.encode('utf-8')
+        scored = []
+        for index in range(low, high):
+            if self._matches(index, encoded):
+                username, _, bio = self.text[self.starts[index]:self.ends[index]].decode('utf-8').partition('\0')
+                scored.append((relevance_score(keyword, username, bio, self.follower_counts[index]), self.follower_counts[index], self.ids[index]))
+        return heapq.nlargest(limit, scored)
+
+    def count(self, keyword: Optional[str], min_followers: Optional[int], max_followers: Optional[int]) -> int:
+        low, high = self._range(min_followers, max_followers)
+        if not keyword:
+            return max(0, high - low)
+        encoded = keyword.encode('utf-8')
+        return sum(1 for index in range(low, high) if self._matches(index, encoded))
+
+
+# Shard held by the current worker process
+shard = Shard()
+
+
+def load_shard(number: int, shards: int) -> int:
+    """
+    Loads the influencers of shard "number" out of "shards" from the database into
+    the worker, returns the amount of influencers loaded
+    """
+    # Imported here so the worker creates its own engine
+    from .database import Session
+
+    db = Session()
+    try:
+        rows = [tuple(row) for row in db.execute(select(*FILTER_COLUMNS).filter(Influencer.id % shards == number))]
+    finally:
+        db.close()
+    shard.load(rows)
+    return len(rows)
+
+
+async def fetch_rows(db, ids: List[int]) -> List[dict]:
+    """
+    Reads the influencers with the given ids in the same order, those missing from
+    the database (deleted, or not on a replica yet) are left out
+    """
+    if not ids:
+        return []
+    statement = select(*SEARCH_COLUMNS).filter(Influencer.id.in_(ids))
+    found = {row.id: dict(row._mapping) for row in await db.execute(statement)}
+    return [found[influencer_id] for influencer_id in ids if influencer_id in found]
+
+
+def add_row(row: tuple) -> None:
+    shard.add(row)
+
+
+def search_shard(*args) -> List[tuple]:
+    return shard.search(*args)
+
+
+def rank_shard(*args) -> List[tuple]:
+    return shard.rank(*args)
+
+
+def count_shard(*args) -> int:
+    return shard.count(*args)
+
+
+class SearchPool:
+    """
+    Process pool answering searches from sharded influencers, it returns the
+    same results as the database search. Each shard gets a single worker
+    process so the rows added to it are applied in order. The pool stops
+    being ready if a worker dies, searches then go back to the database
+    """
+
+    def __init__(self):
+        self.executors: List[ProcessPoolExecutor] = []
+        self.ready = False
+
+    async def start(self, workers: int) -> None:
+        """
+        Starts "workers" processes and loads a shard of the influencers in each
+        """
+        # Spawning fresh interpreters rather than forking the event loop and its threads
+        context = multiprocessing.get_context('spawn')
+        self.executors = [ProcessPoolExecutor(max_workers = 1, mp_context = context) for _ in range(max(workers, 1))]
+        await asyncio.gather(*(self._run(number, load_shard, number, len(self.executors)) for number in range(len(self.executors))))
+        self.ready = True
+
+    def stop(self) -> None:
+        self.ready = False
+        for executor in self.executors:
+            executor.shutdown(wait = False, cancel_futures = True)
+        self.executors = []
+
+    async def _run(self, number: int, function, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executors[number], function, *args)
+        except BrokenProcessPool:
+            self.ready = False
+            raise
+
+    async def _run_all(self, function, *args) -> list:
+        return await asyncio.gather(*(self._run(number, function, *args) for number in range(len(self.executors))))
+
+    def add(self, influencer) -> None:
+        """
+        Adds an influencer (an Influencer or a dict of its columns) to its shard or updates it there
+        """
+        if isinstance(influencer, dict):
+            row = tuple(influencer[column.name] for column in FILTER_COLUMNS)
+        else:
+            row = tuple(getattr(influencer, column.name) for column in FILTER_COLUMNS)
+        try:
+            self.executors[row[ID] % len(self.executors)].submit(add_row, row)
+        except BrokenProcessPool:
+            self.ready = False
+
+    async def search(self, db, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None, limit: int = 50, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Returns a page of influencers matching the search parameters ordered by
+        (follower_count, id) descending and the cursor to the next page, their
+        rows are read from "db". Raises ValueError for a malformed cursor
+        """
+        before = decode_cursor(cursor) if cursor else None
+        # Every shard returns its own first keys past the cursor, one more than the page to know if there is a next one
+        pages = await self._run_all(search_shard, keyword.lower() if keyword else None, min_followers, max_followers, limit + 1, before)
+        page = list(itertools.islice(heapq.merge(*pages, reverse = True), limit + 1))
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(*page[-1])
+        return await fetch_rows(db, [influencer_id for _, influencer_id in page]), next_cursor
+
+    async def rank(self, db, keyword: str, min_followers: Optional[int] = None, max_followers: Optional[int] = None, limit: int = 50) -> List[dict]:
+        """
+        Returns the "limit" influencers matching the search parameters which are most
+        relevant to the keyword, their rows are read from "db"
+        """
+        ranked = await self._run_all(rank_shard, keyword.lower(), min_followers, max_followers, limit)
+        best = heapq.nlargest(limit, itertools.chain(*ranked))
+        return await fetch_rows(db, [influencer_id for _, _, influencer_id in best])
+
+    async def count(self, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None) -> int:
+        """
+        Counts the influencers matching the search parameters
+        """
+        return sum(await self._run_all(count_shard, keyword.lower() if keyword else None, min_followers, max_followers))
+
+
+search_pool = SearchPool()
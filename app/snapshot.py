@@ -0,0 +1,400 @@
+"""
+Columnar snapshot of the influencers table for in-memory search.
+
+Influencers are stored sorted by (follower_count, id) as a few int64 columns
+and two text buffers: the lower cased usernames and bios, searched for
+keywords, and the original ones returned in responses. Row i's username is
+text[offsets[2i]:offsets[2i + 1]] and its bio text[offsets[2i + 1]:offsets[2i + 2]],
+so a follower range is a contiguous slice of every column and of the text
+buffer. Ranges are found with bisect and keywords with bytes.find over the
+slice, without a python object per influencer. The ids are also stored sorted
+along with the row each one is in, to find the row of an influencer.
+
+A snapshot can be saved to a file and memory-mapped, worker processes mapping
+the same file share its pages instead of holding a copy each. Influencers
+created or updated after the snapshot was taken are kept in a small overlay,
+the snapshot rows they replace are masked.
+
+Usage:
+    python -m app.snapshot influencers.snapshot
+"""
+import argparse
+import bisect
+import heapq
+import mmap
+import os
+import struct
+
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import or_, select
+
+from .changes import CHANGED_AT
+from .models import Influencer
+from .search import SEARCH_COLUMNS, decode_cursor, encode_cursor, relevance_score
+
+MAGIC = b'INFSNAP2'
+# Magic, rows, size of the lower cased text, size of the original text, latest change of
+# a row (updated_at or created_at), timestamps are timezone aware
+HEADER = struct.Struct('=8sqqqq?7x')
+# Stored in place of missing timestamps
+NULL_TIME = -2 ** 63
+# Bits of the per row flags
+BIO_NULL = 1
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo = timezone.utc)
+MICROSECOND = timedelta(microseconds = 1)
+
+
+def _pad(size: int) -> int:
+    return size + -size % 8
+
+
+def _encode_time(value: Optional[datetime]) -> int:
+    if value is None:
+        return NULL_TIME
+    return (value - (EPOCH_UTC if value.tzinfo else EPOCH)) // MICROSECOND
+
+
+class SearchSnapshot:
+    """
+    Search over a columnar snapshot of the influencers, it returns the same
+    results as the database search. Filled by "build" (from the database) or
+    "open" (from a saved snapshot), "ready" is set once it can answer searches
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.buffer = b''
+        self.mapping = None
+        self.rows = 0
+        self._clear_overlay()
+
+    def _clear_overlay(self) -> None:
+        # Influencers created or updated since the snapshot was taken sorted by (follower_count, id),
+        # their keys in the same order and the key of every id
+        self.added: List[dict] = []
+        self.added_keys: List[Tuple[int, int]] = []
+        self.added_ids: Dict[int, Tuple[int, int]] = {}
+        # Snapshot rows replaced by an influencer of the overlay
+        self.removed: Set[int] = set()
+
+    def build(self, db) -> None:
+        """
+        Takes a snapshot of all influencers in the database, rows are read as plain
+        tuples in batches and packed straight into the columns
+        """
+        follower_counts, ids, user_ids, created, updated = (array('q') for _ in range(5))
+        text_offsets, display_offsets = array('q', [0]), array('q', [0])
+        flags = bytearray()
+        text, display = bytearray(), bytearray()
+        aware = False
+        changed = NULL_TIME
+
+        statement = select(*SEARCH_COLUMNS).order_by(Influencer.follower_count, Influencer.id).execution_options(yield_per = 1000)
+        for row in db.execute(statement):
+            follower_counts.append(row.follower_count)
+            ids.append(row.id)
+            user_ids.append(row.user_id)
+            created.append(_encode_time(row.created_at))
+            updated.append(_encode_time(row.updated_at))
+            changed = max(changed, updated[-1] if updated[-1] != NULL_TIME else created[-1])
+            aware = aware or any(value is not None and value.tzinfo is not None for value in (row.created_at, row.updated_at))
+            flags.append(BIO_NULL if row.bio is None else 0)
+            for value in (row.username, row.bio or ''):
+                text += value.lower().encode('utf-8')
+                text_offsets.append(len(text))
+                display += value.encode('utf-8')
+                display_offsets.append(len(display))
+
+        id_rows = array('q', sorted(range(len(ids)), key = ids.__getitem__))
+        sorted_ids = array('q', (ids[index] for index in id_rows))
+
+        parts = [HEADER.pack(MAGIC, len(ids), len(text), len(display), changed, aware)]
+        for column in (follower_counts, ids, user_ids, created, updated, sorted_ids, id_rows, text_offsets, display_offsets):
+            parts.append(column.tobytes())
+        for data in (flags, text, display):
+            parts.append(bytes(data) + b'\0' * (_pad(len(data)) - len(data)))
+        self._attach(b''.join(parts))
+        self._clear_overlay()
+
+    def save(self, path: str) -> None:
+        """
+        Writes the snapshot to "path", replacing it at once so processes mapping the old file are not affected
+        """
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(self.buffer)
+        os.replace(temporary, path)
+
+    def open(self, path: str) -> None:
+        """
+        Memory-maps a snapshot saved by "save"
+        """
+        with open(path, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.close()
+        try:
+            self._attach(mapping)
+        except ValueError:
+            mapping.close()
+            raise
+        self.mapping = mapping
+        self._clear_overlay()
+
+    def catch_up(self, db, lookback: float = 0) -> int:
+        """
+        Adds the influencers created or updated since the snapshot was taken to the
+        overlay, returns how many there were. Changes up to "lookback" seconds older
+        than the latest one of the snapshot are read again, for transactions which
+        committed after the snapshot was taken
+        """
+        condition = Influencer.id > self.last_id
+        if self.changed is not None:
+            condition = or_(condition, CHANGED_AT > self.changed - timedelta(seconds = lookback))
+        influencers = db.execute(select(*SEARCH_COLUMNS).filter(condition)).all()
+        for influencer in influencers:
+            self.add(dict(influencer._mapping))
+        return len(influencers)
+
+    def close(self) -> None:
+        """
+        Unmaps the snapshot file, the columns must be released before the mapping can be closed
+        """
+        self.ready = False
+        for name in ('follower_counts', 'ids', 'user_ids', 'created', 'updated', 'sorted_ids', 'id_rows', 'text_offsets', 'display_offsets', 'view'):
+            if hasattr(self, name):
+                getattr(self, name).release()
+                delattr(self, name)
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        self.buffer, self.rows = b'', 0
+
+    def _attach(self, buffer) -> None:
+        if len(buffer) < HEADER.size:
+            raise ValueError('Not an influencer snapshot')
+        magic, rows, text_size, display_size, changed, aware = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('Not an influencer snapshot')
+        self.buffer, self.rows, self.epoch = buffer, rows, EPOCH_UTC if aware else EPOCH
+        self.changed = self._time(changed)
+        self.view = memoryview(buffer)
+        self.last_id = 0
+
+        # Columns are views of the buffer, nothing is copied out of it
+        offset = HEADER.size
+        columns = []
+        for size in (rows, rows, rows, rows, rows, rows, rows, 2 * rows + 1, 2 * rows + 1):
+            columns.append(self.view[offset:offset + 8 * size].cast('q'))
+            offset += 8 * size
+        self.follower_counts, self.ids, self.user_ids, self.created, self.updated, self.sorted_ids, self.id_rows, self.text_offsets, self.display_offsets = columns
+        self.last_id = self.sorted_ids[-1] if rows else 0
+        self.flags_start = offset
+        self.text_start = self.flags_start + _pad(rows)
+        self.display_start = self.text_start + _pad(text_size)
+        self.ready = True
+
+    def add(self, influencer) -> None:
+        """
+        Adds an influencer (an Influencer or a dict of its columns) to the overlay,
+        an influencer of the snapshot or the overlay is replaced unless it did not change
+        """
+        if isinstance(influencer, dict):
+            influencer = {column.name: influencer[column.name] for column in SEARCH_COLUMNS}
+        else:
+            influencer = {column.name: getattr(influencer, column.name) for column in SEARCH_COLUMNS}
+
+        key = self.added_ids.get(influencer['id'])
+        if key is not None:
+            position = bisect.bisect_left(self.added_keys, key)
+            if self.added[position] == influencer:
+                return
+            del self.added[position], self.added_keys[position]
+        else:
+            index = self._find(influencer['id'])
+            if index is not None:
+                if self._row(index) == influencer:
+                    return
+                self.removed.add(index)
+
+        key = (influencer['follower_count'], influencer['id'])
+        position = bisect.bisect_left(self.added_keys, key)
+        self.added.insert(position, influencer)
+        self.added_keys.insert(position, key)
+        self.added_ids[influencer['id']] = key
+
+    def _find(self, influencer_id: int) -> Optional[int]:
+        """
+        Index of the snapshot row of an influencer, from the sorted ids
+        """
+        position = bisect.bisect_left(self.sorted_ids, influencer_id)
+        if position < self.rows and self.sorted_ids[position] == influencer_id:
+            return self.id_rows[position]
+        return None
+
+    def _live(self, low: int, high: int) -> Iterable[int]:
+        """
+        Yields the rows between "low" and "high" which the overlay did not replace,
+        from the highest (follower_count, id) down
+        """
+        return (index for index in range(high - 1, low - 1, -1) if index not in self.removed)
+
+    def _range(self, min_followers: Optional[int], max_followers: Optional[int], before: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+        """
+        Returns the slice of rows within the follower range and below the "before" key
+        """
+        low = bisect.bisect_left(self.follower_counts, min_followers) if min_followers else 0
+        high = bisect.bisect_right(self.follower_counts, max_followers) if max_followers else self.rows
+        if before:
+            start = bisect.bisect_left(self.follower_counts, before[0])
+            stop = bisect.bisect_right(self.follower_counts, before[0], start)
+            high = min(high, bisect.bisect_left(self.ids, before[1], start, stop))
+        return low, high
+
+    def _matches(self, keyword: bytes, low: int, high: int) -> Iterable[int]:
+        """
+        Yields the rows between "low" and "high" whose username or bio contains the
+        lower cased keyword and which the overlay did not replace, from the highest
+        (follower_count, id) down
+        """
+        offsets, size = self.text_offsets, len(keyword)
+        start, end = offsets[2 * low], offsets[2 * high]
+        while True:
+            position = self.buffer.rfind(keyword, self.text_start + start, self.text_start + end) - self.text_start
+            if position < 0:
+                return
+            # Finding the username or bio the match starts in and making sure it does not run into the next one
+            segment = bisect.bisect_right(offsets, position, 2 * low, 2 * high) - 1
+            if position + size <= offsets[segment + 1]:
+                row = segment // 2
+                if row not in self.removed:
+                    yield row
+                end = offsets[2 * row]
+            else:
+                end = position + size - 1
+
+    def _text(self, start: int, offsets, segment: int) -> str:
+        return self.buffer[start + offsets[segment]:start + offsets[segment + 1]].decode('utf-8')
+
+    def _time(self, value: int) -> Optional[datetime]:
+        return None if value == NULL_TIME else self.epoch + value * MICROSECOND
+
+    def _row(self, index: int) -> dict:
+        bio_null = self.buffer[self.flags_start + index] & BIO_NULL
+        return {
+            'id': self.ids[index],
+            'user_id': self.user_ids[index],
+            'username': self._text(self.display_start, self.display_offsets, 2 * index),
+            'follower_count': self.follower_counts[index],
+            'bio': None if bio_null else self._text(self.display_start, self.display_offsets, 2 * index + 1),
+            'created_at': self._time(self.created[index]),
+            'updated_at': self._time(self.updated[index])
+        }
+
+    def _added(self, keyword: Optional[str], min_followers: Optional[int], max_followers: Optional[int], before: Optional[Tuple[int, int]] = None) -> List[dict]:
+        """
+        Influencers of the overlay matching the search parameters, from the highest (follower_count, id) down
+        """
+        return [
+            document for document in reversed(self.added)
+            if (not min_followers or document['follower_count'] >= min_followers)
+            and (not max_followers or document['follower_count'] <= max_followers)
+            and (not before or (document['follower_count'], document['id']) < before)
+            and (not keyword or keyword in document['username'].lower() or bool(document['bio'] and keyword in document['bio'].lower()))
+        ]
+
+    def search(self, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None, limit: int = 50, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Returns a page of influencers matching the search parameters ordered by
+        (follower_count, id) descending and the cursor to the next page, the same
+        way the database search does. Raises ValueError for a malformed cursor
+        """
+        before = decode_cursor(cursor) if cursor else None
+        keyword = keyword.lower() if keyword else None
+        low, high = self._range(min_followers, max_followers, before)
+        rows = self._matches(keyword.encode('utf-8'), low, high) if keyword else self._live(low, high)
+
+        snapshot = [self._row(index) for _, index in zip(range(limit + 1), rows)]
+        merged = heapq.merge(snapshot, self._added(keyword, min_followers, max_followers, before), key = lambda document: (document['follower_count'], document['id']), reverse = True)
+        page = [document for _, document in zip(range(limit + 1), merged)]
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1]['follower_count'], page[-1]['id'])
+        return page, next_cursor
+
+    def rank(self, keyword: str, min_followers: Optional[int] = None, max_followers: Optional[int] = None, limit: int = 50) -> List[dict]:
+        """
+        Returns the "limit" influencers matching the search parameters which are most
+        relevant to the keyword, picked with a bounded heap instead of sorting all matches
+        """
+        keyword = keyword.lower()
+        low, high = self._range(min_followers, max_followers)
+
+        # Scoring snapshot rows from the lower cased text, only the best ones are turned into influencers
+        def key(index):
+            username = self._text(self.text_start, self.text_offsets, 2 * index)
+            bio = self._text(self.text_start, self.text_offsets, 2 * index + 1)
+            return relevance_score(keyword, username, bio, self.follower_counts[index]), self.follower_counts[index], self.ids[index]
+
+        best = [(key(index), self._row(index)) for index in heapq.nlargest(limit, self._matches(keyword.encode('utf-8'), low, high), key = key)]
+        best += [
+            ((relevance_score(keyword, document['username'], document['bio'], document['follower_count']), document['follower_count'], document['id']), document)
+            for document in self._added(keyword, min_followers, max_followers)
+        ]
+        return [document for _, document in heapq.nlargest(limit, best, key = lambda pair: pair[0])]
+
+    def count(self, keyword: Optional[str] = None, min_followers: Optional[int] = None, max_followers: Optional[int] = None) -> int:
+        """
+        Counts the influencers matching the search parameters
+        """
+        keyword = keyword.lower() if keyword else None
+        low, high = self._range(min_followers, max_followers)
+        if keyword:
+            count = sum(1 for _ in self._matches(keyword.encode('utf-8'), low, high))
+        else:
+            count = max(0, high - low) - sum(1 for index in self.removed if low <= index < high)
+        return count + len(self._added(keyword, min_followers, max_followers))
+
+    def histogram(self, bounds: List[int], keyword: str) -> List[int]:
+        """
+        Counts the influencers matching the keyword in each bucket, every bucket
+        is a contiguous range of the snapshot
+        """
+        keyword = keyword.lower()
+        edges = [bisect.bisect_left(self.follower_counts, bound) for bound in bounds] + [self.rows]
+        counts = [sum(1 for _ in self._matches(keyword.encode('utf-8'), low, high)) for low, high in zip(edges, edges[1:])]
+        for document in self._added(keyword, None, None):
+            index = bisect.bisect_right(bounds, document['follower_count']) - 1
+            if index >= 0:
+                counts[index] += 1
+        return counts
+
+
+search_snapshot = SearchSnapshot()
+
+
+def main(args: Iterable[str] = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Take a columnar snapshot of the influencers for in-memory search')
+    parser.add_argument('path', help = 'File the snapshot is written to')
+    args = parser.parse_args(args)
+
+    from .database import Session
+
+    db = Session()
+    try:
+        snapshot = SearchSnapshot()
+        snapshot.build(db)
+        snapshot.save(args.path)
+    finally:
+        db.close()
+    print(f'{snapshot.rows} influencers written to {args.path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,77 @@ from fastapi.testclient import TestClient
 
 import pytest
 
+import bcrypt
+
+import asyncio
+
+import httpx
+
+import json
+
+import os
+
+import subprocess
+
+import sys
+
+import time
+
+from datetime import timedelta
+
+from . import main
+
 from .main import app
 
+from .database import AsyncSessionLocal, Session, ReplicaRouter, ReplicaSessionLocal, get_async_engine
+
+from .search_index import SearchIndex
+
+from .search_pool import SearchPool
+
+from .snapshot import SearchSnapshot
+
+from .encoding import dumps
+
+from .fuzzy import UsernameIndex, bounded_distance, edit_distance, username_index
+
+from .ratelimit import MemoryBuckets, RateLimiter
+
+from .bloom import BloomFilter
+
+from .facets import FollowerSummary
+
+from .writes import row_error, ALREADY_INFLUENCER, USERNAME_TAKEN, USER_MISSING
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .models import User, Influencer
+
+from .utils import hash_password, needs_rehash, password_pool
+
+from .auth import AuthJWT, user_registry
+
+from .cache import MemoryCache
+
+from .config import settings
+
 client = TestClient(app)
 
+# Seconds importing the app may take, it must not create engines or load database drivers
+IMPORT_BUDGET_SECONDS = 1.5
+
+@pytest.fixture(scope = "module", autouse = True)
+def lifespan():
+    """
+    Runs the app's startup and shutdown events around the tests and keeps
+    a single event loop for the async database connections
+    """
+    with client:
+        yield
+
 def test_register():
     """
     Testing the "/register" endpoint of the application
@@ -31,6 +98,8 @@ def test_register():
     assert response.json()["data"]["email"] == data["email"]
     # Making sure password was stripped from the returned user
     assert "password" not in response.json().keys()
+    # Making sure the client reads from the primary database until replicas have the new user
+    assert "read_primary_until" in response.cookies
 
     # Retrying another registration request with an email that has 
     # already been used an making sure that the response is a bad one
@@ -38,6 +107,38 @@ def test_register():
     assert response.status_code == 403
 
 
+def test_register_unique_constraint():
+    """
+    Testing that registering an email the uniqueness filter does not know of is
+    refused by the unique constraint
+    """
+    # Adding a user behind the app's back so the filter does not have its email
+    db = Session()
+    db.add(User(email = "unfiltered@gmail.com", password = hash_password("testpassword")))
+    db.commit()
+    db.close()
+
+    response = client.post("/register", json = {"email": "unfiltered@gmail.com", "password": "testpassword"})
+    assert response.status_code == 403
+
+
+def test_password_pool_saturated(monkeypatch):
+    """
+    Testing that requests needing a password hash get a 503 asking to retry when the password pool is full
+    """
+    data = {"email": "saturated@gmail.com", "password": "testpassword"}
+    monkeypatch.setattr(password_pool, "capacity", 0)
+    response = client.post("/register", json = data)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert password_pool.pending == 0
+
+    # Retrying once the pool has room again
+    monkeypatch.undo()
+    response = client.post("/register", json = data)
+    assert response.status_code == 201
+
+
 def test_login_and_refresh():
     """
     Testing the "/login" endpoint of the application
@@ -116,6 +217,94 @@ def test_onboarding():
     assert response.status_code == 403
 
 
+def test_onboarding_batch(monkeypatch):
+    """
+    Testing that concurrent onboarding requests arriving within the batch window
+    share one flush, and that only the rows violating a constraint get a 403
+    """
+    sizes = []
+    flush = main.onboarding_writer.flush
+
+    async def counted_flush(batch):
+        sizes.append(len(batch))
+        await flush(batch)
+
+    monkeypatch.setattr(main.onboarding_writer, "window", 0.5)
+    monkeypatch.setattr(main.onboarding_writer, "flush", counted_flush)
+
+    db = Session()
+    users = [User(email = f"batch{i}@test.com", password = "x") for i in range(5)]
+    db.add_all(users)
+    db.commit()
+    user_ids = [user.id for user in users]
+    db.close()
+
+    def headers(user_id):
+        return {"Authorization": f"Bearer {AuthJWT().create_access_token(subject = str(user_id))}"}
+
+    # Two users asking for the same username and one user asking for two profiles
+    requests = [
+        (user_ids[0], "batch_shared"),
+        (user_ids[1], "batch_shared"),
+        (user_ids[2], "batch_profile"),
+        (user_ids[2], "batch_extra"),
+        (user_ids[3], "batch_three"),
+        (user_ids[4], "batch_four"),
+    ]
+
+    async def onboard():
+        async with httpx.AsyncClient(app = app, base_url = "http://testserver") as http:
+            return await asyncio.gather(*[
+                http.post("/onboarding", json = {"username": username, "follower_count": 10}, headers = headers(user_id))
+                for user_id, username in requests
+            ])
+
+    responses = client.portal.call(onboard)
+    assert sizes == [len(requests)]
+
+    shared, profiles, others = responses[:2], responses[2:4], responses[4:]
+    assert sorted(response.status_code for response in shared) == [201, 403]
+    assert [response.json()["detail"] for response in shared if response.status_code == 403] == [USERNAME_TAKEN]
+    assert sorted(response.status_code for response in profiles) == [201, 403]
+    assert [response.json()["detail"] for response in profiles if response.status_code == 403] == [ALREADY_INFLUENCER]
+    assert all(response.status_code == 201 for response in others)
+    assert [response.json()["data"]["username"] for response in others] == ["batch_three", "batch_four"]
+
+
+def test_onboarding_row_errors():
+    """
+    Testing that violations of a batched onboarding row are told apart, on SQLite and PostgreSQL messages
+    """
+    def error(message):
+        return row_error(IntegrityError("INSERT INTO influencers", {}, Exception(message)))
+
+    assert error("UNIQUE constraint failed: influencers.username").detail == USERNAME_TAKEN
+    assert error('duplicate key value violates unique constraint "influencers_user_id_key"').detail == ALREADY_INFLUENCER
+    assert error('insert or update on table "influencers" violates foreign key constraint "influencers_user_id_fkey"').detail == USER_MISSING
+    other = error("NOT NULL constraint failed: influencers.follower_count")
+    assert isinstance(other, IntegrityError)
+
+
+def test_username_availability():
+    """
+    Testing the "/usernames/availability" endpoint
+    """
+    assert not client.get("/usernames/availability?username=test").json()["data"]["available"]
+    assert client.get("/usernames/availability?username=nobody-has-this").json()["data"]["available"]
+
+
+def test_bloom_filter():
+    """
+    Testing the Bloom filter has no false negatives and about the expected false positives
+    """
+    bloom = BloomFilter(capacity = 1000, error_rate = 0.01)
+    for number in range(1000):
+        bloom.add(f"user{number}@gmail.com")
+    assert all(f"user{number}@gmail.com" in bloom for number in range(1000))
+    false_positives = sum(f"other{number}@gmail.com" in bloom for number in range(10000))
+    assert false_positives < 300
+
+
 def test_search():
     """
     Testing the "/search" endpoint
@@ -139,6 +328,598 @@ def test_search():
         assert data["follower_count"] >= min_followers
 
 
+def test_search_pagination():
+    """
+    Testing paging through the "/search" endpoint with cursors
+    """
+    endpoint = "/search?limit=1&total=exact"
+
+    # Requesting the first page and asserting that a cursor to the next page is returned
+    response = client.get(endpoint)
+    assert response.status_code == 200
+    assert response.json()["count"] == 1
+    assert response.json()["total"] >= 1
+    next_cursor = response.json()["next_cursor"]
+
+    # Following cursors until the last page and making sure no influencer is returned twice
+    seen = [response.json()["data"][0]["id"]]
+    while next_cursor:
+        response = client.get(endpoint + "&cursor=" + next_cursor)
+        assert response.status_code == 200
+        seen += [data["id"] for data in response.json()["data"]]
+        next_cursor = response.json()["next_cursor"]
+    assert len(seen) == len(set(seen))
+    assert len(seen) == response.json()["total"]
+
+    # Sending a malformed cursor and making sure the response is a bad one
+    response = client.get(endpoint + "&cursor=notacursor")
+    assert response.status_code == 400
+
+
+def test_search_stream():
+    """
+    Testing the "/search/stream" endpoint returns the same influencers as "/search"
+    """
+    endpoint = "/search/stream?keyword=instagram"
+
+    # Sending request and parsing the NDJSON lines of the response
+    response = client.get(endpoint)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    streamed = [json.loads(line) for line in response.text.splitlines()]
+
+    # Making sure the influencers match the ones from "/search"
+    assert streamed == client.get("/search?keyword=instagram").json()["data"]
+
+
+def test_search_cache():
+    """
+    Testing that repeated searches are served from the cache
+    """
+    endpoint = "/search?keyword=Instagram&min_followers=99"
+
+    if not client.get("/search/cache").json()["data"]["enabled"]:
+        pytest.skip("Search cache is disabled")
+
+    # Sending the same search twice and making sure the second one was a cache hit
+    first = client.get(endpoint)
+    hits = client.get("/search/cache").json()["data"]["hits"]
+    second = client.get(endpoint)
+    assert second.json() == first.json()
+    assert client.get("/search/cache").json()["data"]["hits"] == hits + 1
+
+
+def test_search_etag(monkeypatch):
+    """
+    Testing that repeated searches get a 304 until an influencer changes, and compressed responses
+    """
+    endpoint = "/search?total=exact"
+
+    # Sending the ETag of a search back
+    first = client.get(endpoint)
+    tag = first.headers["ETag"]
+    second = client.get(endpoint, headers = {"If-None-Match": tag})
+    assert second.status_code == 304
+    assert second.content == b""
+    assert second.headers["ETag"] == tag
+    assert client.get(endpoint, headers = {"If-None-Match": f'"other", W/{tag}'}).status_code == 304
+    assert client.get("/search?total=estimated", headers = {"If-None-Match": tag}).status_code == 200
+
+    # Importing an influencer, which gives a new version of the influencers
+    monkeypatch.setattr(settings, "BULK_IMPORT_TOKEN", "testtoken")
+    row = {"email": "etag@test.com", "password_hash": hash_password("testpassword"), "username": "etagprobe", "follower_count": 1}
+    assert client.post("/influencers/bulk", content = json.dumps(row), headers = {"X-Import-Token": "testtoken"}).json()["data"]["inserted"] == 1
+    response = client.get(endpoint, headers = {"If-None-Match": tag})
+    assert response.status_code == 200
+    assert response.json()["total"] == first.json()["total"] + 1
+    assert response.headers["ETag"] != tag
+
+    # Compressing every response (of a search not cached yet), the encoding is part of the ETag
+    monkeypatch.setattr(settings, "SEARCH_COMPRESS_MIN_SIZE", 1)
+    endpoint = "/search?total=exact&limit=20"
+    compressed = client.get(endpoint, headers = {"Accept-Encoding": "gzip"})
+    plain = client.get(endpoint, headers = {"Accept-Encoding": "identity"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in plain.headers
+    assert compressed.json() == plain.json()
+    assert len({compressed.headers["ETag"], plain.headers["ETag"]}) == 2
+    assert client.get(endpoint, headers = {"Accept-Encoding": "gzip;q=0"}).headers.get("Content-Encoding") is None
+
+
+def test_replica_failover(tmp_path):
+    """
+    Testing that read sessions only connect to their replica for their first query, and move to the primary when it is down
+    """
+    replica = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/replica.db")
+    router = ReplicaRouter(get_async_engine(), [replica], "round_robin", 30)
+
+    async def count_influencers():
+        async with ReplicaSessionLocal(bind = replica, router = router) as db:
+            assert replica not in router.down_until
+            return (await db.execute(select(func.count(Influencer.id)))).scalar()
+
+    # Running the query on the app's event loop, which the async engine's connections belong to
+    db = Session()
+    assert client.portal.call(count_influencers) == db.query(Influencer).count()
+    db.close()
+    assert replica in router.down_until
+
+
+def test_prewarm_unreachable_replica(tmp_path, monkeypatch):
+    """
+    Testing that a replica which can not be reached at startup is marked down instead of failing the startup
+    """
+    replica = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/replica.db", poolclass = AsyncAdaptedQueuePool)
+    router = ReplicaRouter(get_async_engine(), [replica], "round_robin", 30)
+    monkeypatch.setattr(main, "get_replica_engines", lambda: [replica])
+    monkeypatch.setattr(main, "get_replica_router", lambda: router)
+    client.portal.call(main.prewarm_pools)
+    assert replica in router.down_until
+
+
+def test_search_index():
+    """
+    Testing that the in-process search index returns the same influencers as "/search"
+    """
+    # Building an index from the influencers in the DB
+    db = Session()
+    index = SearchIndex()
+    index.build(db)
+    db.close()
+
+    # Comparing results of the index and the endpoint for a few searches
+    for params in [{}, {"keyword": "instagram"}, {"keyword": "TES"}, {"keyword": "er"}, {"keyword": "nothing like this"}, {"min_followers": 99, "max_followers": 200}, {"min_followers": 101, "keyword": "t"}]:
+        response = client.get("/search", params = params)
+        data, _ = index.search(**params)
+        assert [influencer["id"] for influencer in data] == [influencer["id"] for influencer in response.json()["data"]]
+        assert index.count(**params) == response.json()["count"]
+
+    # Comparing relevance ranking of the index and the endpoint
+    for params in [{"keyword": "instagram"}, {"keyword": "test"}, {"keyword": "t", "min_followers": 5}]:
+        response = client.get("/search", params = dict(params, sort = "relevance"))
+        assert [influencer["id"] for influencer in index.rank(**params)] == [influencer["id"] for influencer in response.json()["data"]]
+
+
+def test_search_snapshot(tmp_path):
+    """
+    Testing that a memory-mapped snapshot of the influencers returns the same influencers as "/search"
+    """
+    # Taking a snapshot of the influencers in the DB, saving and mapping it
+    db = Session()
+    snapshot = SearchSnapshot()
+    snapshot.build(db)
+    db.close()
+    snapshot.save(str(tmp_path / "influencers.snapshot"))
+    snapshot.open(str(tmp_path / "influencers.snapshot"))
+
+    try:
+        # Comparing whole influencers of the snapshot and the endpoint for a few searches
+        for params in [{}, {"keyword": "instagram"}, {"keyword": "TES"}, {"keyword": "er"}, {"keyword": "nothing like this"}, {"min_followers": 99, "max_followers": 200}, {"min_followers": 101, "keyword": "t"}]:
+            response = client.get("/search", params = dict(params, total = "exact"))
+            data, _ = snapshot.search(**params)
+            assert json.loads(dumps(data)) == response.json()["data"]
+            assert snapshot.count(**params) == response.json()["total"]
+
+        # Comparing relevance ranking and keyword histograms
+        for params in [{"keyword": "instagram"}, {"keyword": "test"}, {"keyword": "t", "min_followers": 5}]:
+            response = client.get("/search", params = dict(params, sort = "relevance"))
+            assert [influencer["id"] for influencer in snapshot.rank(**params)] == [influencer["id"] for influencer in response.json()["data"]]
+        response = client.get("/influencers/histogram?keyword=instagram&buckets=0,100,150")
+        assert snapshot.histogram([0, 100, 150], "instagram") == [bucket["matches"] for bucket in response.json()["data"]]
+
+        # Updating an influencer after the snapshot was saved, mapping the file again catches up with it
+        db = Session()
+        influencer = db.query(Influencer).order_by(Influencer.id).first()
+        influencer_id, updated_at = influencer.id, snapshot.changed + timedelta(seconds = 1)
+        influencer.updated_at = updated_at
+        db.commit()
+        snapshot.open(str(tmp_path / "influencers.snapshot"))
+        assert snapshot.catch_up(db) >= 1
+        db.close()
+        data, _ = snapshot.search(limit = 500)
+        assert [found["updated_at"] for found in data if found["id"] == influencer_id] == [updated_at]
+        assert len(data) == snapshot.count() == snapshot.rows
+    finally:
+        snapshot.close()
+
+
+def test_search_pool():
+    """
+    Testing that searches split between worker processes return the same influencers as "/search"
+    """
+    def run(method, *args, **params):
+        # Calling the pool on the loop of the app, with a session to read the rows of the result from
+        async def call():
+            async with AsyncSessionLocal() as db:
+                return await method(*((db,) if method != pool.count else ()), *args, **params)
+        return client.portal.call(call)
+
+    # Splitting the influencers of the DB between two workers
+    pool = SearchPool()
+    client.portal.call(pool.start, 2)
+    try:
+        for params in [{}, {"keyword": "instagram"}, {"keyword": "TES"}, {"min_followers": 99, "max_followers": 200}, {"min_followers": 101, "keyword": "t"}]:
+            response = client.get("/search", params = dict(params, limit = 1, total = "exact"))
+            data, next_cursor = run(pool.search, **params, limit = 1)
+            assert [influencer["id"] for influencer in data] == [influencer["id"] for influencer in response.json()["data"]]
+            assert next_cursor == response.json()["next_cursor"]
+            assert run(pool.count, **params) == response.json()["total"]
+
+            # Following the cursor to the next page
+            if next_cursor:
+                response = client.get("/search", params = dict(params, limit = 1, cursor = next_cursor))
+                data, _ = run(pool.search, **params, limit = 1, cursor = next_cursor)
+                assert [influencer["id"] for influencer in data] == [influencer["id"] for influencer in response.json()["data"]]
+
+        for params in [{"keyword": "instagram"}, {"keyword": "test"}, {"keyword": "t", "min_followers": 5}]:
+            response = client.get("/search", params = dict(params, sort = "relevance"))
+            assert [influencer["id"] for influencer in run(pool.rank, **params)] == [influencer["id"] for influencer in response.json()["data"]]
+    finally:
+        pool.stop()
+
+
+def test_search_pool_worker_died(monkeypatch):
+    """
+    Testing that searches and onboarding carry on without the search pool once one of its workers died
+    """
+    pool = SearchPool()
+    asyncio.run(pool.start(1))
+    try:
+        monkeypatch.setattr(main, "search_pool", pool)
+        for process in pool.executors[0]._processes.values():
+            process.kill()
+            process.join()
+
+        # The search which finds the worker dead is answered by the database
+        params = {"keyword": "instagram", "min_followers": 1, "total": "exact"}
+        response = client.get("/search", params = params)
+        assert response.status_code == 200
+        assert not pool.ready
+        assert response.json()["total"] == client.get("/search", params = dict(params, limit = 20)).json()["total"]
+
+        # Adding influencers to the pool no longer fails
+        pool.ready = True
+        pool.add(response.json()["data"][0])
+        assert not pool.ready
+    finally:
+        pool.stop()
+
+
+def test_bulk_import(monkeypatch):
+    """
+    Testing the "/influencers/bulk" endpoint
+    """
+    endpoint = "/influencers/bulk"
+    monkeypatch.setattr(settings, "BULK_IMPORT_TOKEN", "testtoken")
+
+    rows = [
+        {"email": "bulk1@gmail.com", "password": "testpassword", "username": "bulk1", "follower_count": 150, "bio": "Imported instagram influencer, test account"},
+        {"email": "bulk2@gmail.com", "password_hash": hash_password("testpassword"), "username": "bulk2", "follower_count": 10},
+        {"email": "test@gmail.com", "password": "testpassword", "username": "bulk3", "follower_count": 10},
+        {"email": "notanemail", "password": "testpassword", "username": "bulk4", "follower_count": 10},
+    ]
+    body = "\n".join(json.dumps(row) for row in rows)
+
+    # Sending request without the import token and making sure it is refused
+    response = client.post(endpoint, content = body)
+    assert response.status_code == 403
+
+    # Sending request with the token and making sure the bad rows were reported
+    response = client.post(endpoint, content = body, headers = {"X-Import-Token": "testtoken"})
+    assert response.status_code == 200
+    report = response.json()["data"]
+    assert report["rows"] == 4
+    assert report["inserted"] == 2
+    assert [error["row"] for error in report["errors"]] == [4, 3]
+
+    # Making sure the imported influencers can be found and can log in
+    response = client.get("/search?keyword=imported")
+    assert [data["username"] for data in response.json()["data"]] == ["bulk1"]
+    response = client.post("/login", json = {"email": "bulk2@gmail.com", "password": "testpassword"})
+    assert response.status_code == 200
+
+    # Importing CSV with a quoted bio spanning lines, a malformed hash and a line which is not UTF-8
+    body = b"\n".join([
+        b"email,password,password_hash,username,follower_count,bio",
+        b'csv1@gmail.com,testpassword,,csvmultiline,20,"First line',
+        b'second ""line"""',
+        b"csv2@gmail.com,,$2b$10$tooshort,csvbadhash,20,",
+        b"csv3@gmail.com,testpassword,,csv\xff,20,",
+        b"csv4@gmail.com,testpassword,,csvlast,20,Last",
+    ])
+    response = client.post(endpoint, content = body, headers = {"X-Import-Token": "testtoken", "Content-Type": "text/csv"})
+    assert response.status_code == 200
+    report = response.json()["data"]
+    assert (report["rows"], report["inserted"]) == (4, 2)
+    assert [error["row"] for error in report["errors"]] == [2, 3]
+    response = client.get("/search?keyword=second")
+    assert [(data["username"], data["bio"]) for data in response.json()["data"]] == [("csvmultiline", 'First line\nsecond "line"')]
+
+
+def test_search_relevance():
+    """
+    Testing that "sort=relevance" puts the best keyword matches first
+    """
+    # "test" matches the username of the first influencer and only the bio of "bulk1" which
+    # has more followers, ranking by relevance has to put the username match first
+    response = client.get("/search?keyword=test")
+    assert [data["username"] for data in response.json()["data"]] == ["bulk1", "test"]
+    response = client.get("/search?keyword=test&sort=relevance")
+    assert response.status_code == 200
+    assert [data["username"] for data in response.json()["data"]] == ["test", "bulk1"]
+    assert response.json()["next_cursor"] is None
+
+    # Making sure cursors are refused with relevance sorting
+    response = client.get("/search?keyword=test&sort=relevance&cursor=abc")
+    assert response.status_code == 400
+
+
+def test_fuzzy_search(monkeypatch):
+    """
+    Testing the "/search/fuzzy" endpoint finds misspelled usernames
+    """
+    # Misspelling "test" and making sure it is found along with the amount of typos
+    response = client.get("/search/fuzzy?username=TSET&max_distance=2")
+    if response.status_code == 503:
+        pytest.skip("Fuzzy search is not available on this database")
+    assert response.status_code == 200
+    assert response.json()["count"] == len(response.json()["data"])
+    assert {"username": "test", "distance": 2}.items() <= response.json()["data"][0].items()
+
+    # Asking for exact matches only and for too many typos
+    assert [influencer["username"] for influencer in client.get("/search/fuzzy?username=tset&max_distance=0").json()["data"]] == []
+    assert client.get("/search/fuzzy?username=test&max_distance=100").status_code == 422
+
+    # Refusing searches which would check too many usernames
+    if username_index.ready:
+        monkeypatch.setattr(username_index, "max_candidates", 0)
+        assert client.get("/search/fuzzy?username=tst").status_code == 400
+
+
+def test_username_index():
+    """
+    Testing that the username index finds the same usernames as comparing with every one of them
+    """
+    usernames = ["test", "tset", "testuser", "toast", "best", "tester", "rest", "t", "", "TEST2", "quite different", "aaaa", "aa"]
+    index = UsernameIndex()
+    index.ready = True
+    for influencer_id, username in enumerate(usernames):
+        index.add(influencer_id, username)
+    # Moving an influencer to another username and back
+    index.add(1, "elsewhere")
+    index.add(1, "tset")
+
+    assert edit_distance("kitten", "sitting") == 3
+    for query in ["test", "tst", "TESTS", "x", "", "aaa", "testusers"]:
+        for max_distance in range(4):
+            expected = sorted((edit_distance(query.lower(), username.lower()), influencer_id) for influencer_id, username in enumerate(usernames))
+            assert index.search(query, max_distance) == [pair for pair in expected if pair[0] <= max_distance]
+            assert all(bounded_distance(query.lower(), username.lower(), max_distance) == min(distance, max_distance + 1) for distance, username in zip((edit_distance(query.lower(), username.lower()) for username in usernames), usernames))
+
+    # Refusing searches leaving more usernames to check than allowed
+    index.max_candidates = 2
+    with pytest.raises(ValueError):
+        index.search("t", 2)
+
+
+def test_change_feed():
+    """
+    Testing that influencers inserted and updated behind the app's back reach its in-memory state
+    """
+    if settings.CHANGE_FEED == "off" or client.get("/search/fuzzy?username=test").status_code == 503:
+        pytest.skip("Change feed or username tree is disabled")
+
+    def found(username):
+        response = client.get("/search/fuzzy", params = {"username": username, "max_distance": 0})
+        return [influencer["username"] for influencer in response.json()["data"]] == [username]
+
+    def wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+    # Inserting a user and their influencer profile directly in the DB
+    db = Session()
+    user = User(email = "feed@test.com", password = "not a hash")
+    db.add(user)
+    db.commit()
+    influencer = Influencer(user_id = user.id, username = "changefeed", follower_count = 12, bio = "Written elsewhere")
+    db.add(influencer)
+    db.commit()
+    db.refresh(influencer)
+    wait_for(lambda: found("changefeed"))
+
+    # Renaming the influencer, updated_at is set by hand as SQLite only keeps seconds
+    influencer.username = "feedchanged"
+    influencer.updated_at = influencer.created_at + timedelta(seconds = 1)
+    db.commit()
+    db.close()
+    wait_for(lambda: found("feedchanged") and not found("changefeed"))
+
+
+def test_in_memory_updates():
+    """
+    Testing that updated influencers replace their old version in the in-memory structures, however often they are applied
+    """
+    db = Session()
+    index, snapshot, summary = SearchIndex(), SearchSnapshot(), FollowerSummary()
+    index.build(db)
+    snapshot.build(db)
+    db.close()
+    summary.ready = True
+    for document in index.documents.values():
+        summary.add(document["id"], document["follower_count"])
+
+    # Changing the follower count and bio of an influencer, applied twice
+    document = dict(next(iter(index.documents.values())), follower_count = 123456, bio = "Updated bio with unusualword")
+    for _ in range(2):
+        for structure in (index, snapshot):
+            structure.add(document)
+        summary.add(document["id"], document["follower_count"])
+
+    assert len(index.keys) == len(index.documents) == len(summary.counts) == snapshot.count()
+    assert [influencer["id"] for influencer in index.search("unusualword")[0]] == [document["id"]]
+    assert snapshot.search("unusualword")[0] == [index.documents[document["id"]]]
+    for params in [{}, {"keyword": "instagram"}, {"min_followers": 100000}, {"keyword": "t", "max_followers": 200}]:
+        assert [influencer["id"] for influencer in snapshot.search(**params)[0]] == [influencer["id"] for influencer in index.search(**params)[0]]
+        assert snapshot.count(**params) == index.count(**params)
+    assert summary.count(100000) == index.count(min_followers = 100000)
+    snapshot.close()
+
+
+def test_follower_histogram():
+    """
+    Testing the "/influencers/histogram" endpoint
+    """
+    # Making sure the log scale buckets add up to all influencers
+    response = client.get("/influencers/histogram?keyword=instagram")
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert [(bucket["min"], bucket["max"]) for bucket in data[:3]] == [(0, 0), (1, 9), (10, 99)]
+    assert sum(bucket["count"] for bucket in data) == client.get("/search?total=exact").json()["total"]
+    assert sum(bucket["matches"] for bucket in data) == client.get("/search?keyword=instagram&total=exact").json()["total"]
+
+    # Asking for custom buckets and comparing them with searches
+    response = client.get("/influencers/histogram?buckets=100,151")
+    assert [bucket["count"] for bucket in response.json()["data"]] == [
+        client.get("/search?min_followers=100&max_followers=150&total=exact").json()["total"],
+        client.get("/search?min_followers=151&total=exact").json()["total"]
+    ]
+
+    # Sending malformed buckets
+    response = client.get("/influencers/histogram?buckets=1,a")
+    assert response.status_code == 400
+
+
+def test_login_rate_limit():
+    """
+    Testing that repeated logins to an email are refused once its bucket is empty
+    """
+    data = {"email": "ratelimited@gmail.com", "password": "testpassword"}
+
+    # Making sure the attempts within the burst reach the route and the next one is refused
+    for _ in range(settings.LOGIN_BURST_PER_EMAIL):
+        assert client.post("/login", json = data).status_code == 401
+    response = client.post("/login", json = data)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+    # Making sure other emails can still log in
+    assert client.post("/login", json = {"email": "test@gmail.com", "password": "testpassword"}).status_code == 200
+
+
+def test_token_buckets():
+    """
+    Testing the token buckets refill over time and only keep the most recent keys
+    """
+    buckets = MemoryBuckets(max_keys = 2)
+    limiter = RateLimiter(buckets, "test", ip_per_minute = 0, ip_burst = 0, email_per_minute = 60, email_burst = 2)
+
+    assert limiter.check("1.2.3.4", "a@gmail.com") == 0
+    assert limiter.check("1.2.3.4", "a@gmail.com") == 0
+    assert 0 < limiter.check("1.2.3.4", "a@gmail.com") <= 1
+    assert limiter.rejected == 1
+
+    # Filling the store up so the bucket of the first email is evicted and starts full again
+    limiter.check(None, "b@gmail.com")
+    limiter.check(None, "c@gmail.com")
+    assert len(buckets) == 2
+    assert limiter.check(None, "a@gmail.com") == 0
+
+
+def test_needs_rehash():
+    """
+    Testing that hashes made with another cost factor are flagged for rehashing
+    """
+    assert not needs_rehash(hash_password("testpassword"))
+    rounds = 4 if settings.BCRYPT_ROUNDS != 4 else 5
+    assert needs_rehash(bcrypt.hashpw(b"testpassword", bcrypt.gensalt(rounds)).decode('utf-8'))
+
+
+def test_metrics():
+    """
+    Testing the "/metrics" endpoint reports the requests made so far
+    """
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds_count{method="GET",route="/search",status="200"}' in response.text
+    assert 'http_request_phase_seconds_total{method="POST",route="/login",status="200",phase="bcrypt"}' in response.text
+    assert 'db_statements_total{method="POST",route="/register",status="201"}' in response.text
+    # Making sure connection checkouts of the primary pool were timed
+    assert 'db_pool_checkout_wait_seconds_count{pool="primary"}' in response.text
+
+
+def test_ready():
+    """
+    Testing the "/ready" endpoint reports the warm-up steps once startup finished
+    """
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["data"]["ready"]
+    assert "pools" in response.json()["data"]["steps"]
+
+
+def test_import_time():
+    """
+    Testing that importing the app stays within its time budget and defers
+    creating the engines and loading the database drivers to startup
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import app.main, app.database\n"
+        "print(time.perf_counter() - start)\n"
+        "print(app.database.get_engine.cache_info().currsize + app.database.get_async_engine.cache_info().currsize)\n"
+        "print(any(driver in sys.modules for driver in ('aiosqlite', 'asyncpg', 'psycopg2')))\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    seconds, engines, drivers_loaded = subprocess.run([sys.executable, "-c", code], cwd = root, capture_output = True, text = True, check = True).stdout.split()
+    assert float(seconds) < IMPORT_BUDGET_SECONDS
+    assert engines == "0"
+    assert drivers_loaded == "False"
+
+
+def test_stateless_auth(monkeypatch):
+    """
+    Testing the user registry of AUTH_MODE=stateless through "authenticate" (an
+    empty onboarding body gets 422 once authenticated) and "/refresh"
+    """
+    monkeypatch.setattr(user_registry, "cache", MemoryCache(100, 60))
+    monkeypatch.setattr(user_registry, "enabled", True)
+
+    def headers(user_id, refresh = False):
+        auth = AuthJWT()
+        token = auth.create_refresh_token(subject = str(user_id)) if refresh else auth.create_access_token(subject = str(user_id))
+        return {"Authorization": f"Bearer {token}"}
+
+    # Ids the registry knows are trusted without a lookup
+    user_registry.add(987654)
+    assert client.post("/onboarding", json = {}, headers = headers(987654)).status_code == 422
+    assert client.get("/refresh", headers = headers(987654, refresh = True)).status_code == 200
+
+    # Ids it does not know yet are looked up and remembered
+    db = Session()
+    user = User(email = "stateless@test.com", password = hash_password("testpassword"))
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    assert user_registry.cache.get(user_id) is None
+    assert client.post("/onboarding", json = {}, headers = headers(user_id)).status_code == 422
+    assert user_registry.cache.get(user_id)
+    assert client.post("/onboarding", json = {}, headers = headers(123456789)).status_code == 401
+    assert user_registry.cache.get(123456789) is None
+
+    # Deleted users are refused once the registry forgot them
+    db.delete(user)
+    db.commit()
+    db.close()
+    monkeypatch.setattr(user_registry.cache, "ttl", 0)
+    user_registry.add(user_id)
+    assert client.post("/onboarding", json = {}, headers = headers(user_id)).status_code == 401
+    assert client.get("/refresh", headers = headers(user_id, refresh = True)).status_code == 401
+
+
 def test_logout():
     """
     Tests the "/logout" endpoint of the app
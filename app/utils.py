@@ -1,11 +1,51 @@
+import asyncio
 import bcrypt
 
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import settings
+
+from .metrics import timed
+
+
+class PasswordPoolSaturated(Exception):
+    """
+    Raised when the password hashing pool has no room for more work
+    """
+
+
+class PasswordPool:
+    """
+    Runs bcrypt on a dedicated thread pool so hashing does not block the
+    event loop. At most "workers + queue_size" calls may be running or
+    waiting at once, calls beyond that are refused with PasswordPoolSaturated
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'bcrypt')
+        self.capacity = workers + queue_size
+        # Only touched from the event loop, so no lock is needed
+        self.pending = 0
+
+    async def run(self, function, *args):
+        if self.pending >= self.capacity:
+            raise PasswordPoolSaturated()
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.pending -= 1
+
+
+password_pool = PasswordPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_QUEUE)
+
+
 def hash_password(password: str) -> str:
     """
     Hashes a password and returns the hash
     """
     byte_pwd = password.encode('utf-8')
-    salt = bcrypt.gensalt(10)
+    salt = bcrypt.gensalt(settings.BCRYPT_ROUNDS)
     hash = bcrypt.hashpw(byte_pwd, salt)
     return hash.decode('utf-8')
 
@@ -13,4 +53,24 @@ def compare_password(password: str, hash: str) -> bool:
     """
     Compares provided password with hashed password
     """
-    return bcrypt.checkpw(password.encode('utf-8'), hash.encode('utf-8'))
\ No newline at end of file
+    return bcrypt.checkpw(password.encode('utf-8'), hash.encode('utf-8'))
+
+def needs_rehash(hash: str) -> bool:
+    """
+    Checks if a hash was made with a cost factor other than the configured one
+    """
+    return int(hash.split('$')[2]) != settings.BCRYPT_ROUNDS
+
+async def hash_password_async(password: str) -> str:
+    """
+    Hashes a password on the password pool
+    """
+    with timed('bcrypt'):
+        return await password_pool.run(hash_password, password)
+
+async def compare_password_async(password: str, hash: str) -> bool:
+    """
+    Compares a password with a hash on the password pool
+    """
+    with timed('bcrypt'):
+        return await password_pool.run(compare_password, password, hash)
@@ -0,0 +1,152 @@
+import asyncio
+
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+
+from .database import AsyncSessionLocal
+from .models import Influencer
+from .search import SEARCH_COLUMNS
+
+USERNAME_TAKEN = "An influencer with this username has already been recorded"
+ALREADY_INFLUENCER = "This user is already an influencer"
+USER_MISSING = "The user of this influencer no longer exists"
+
+
+class OnboardingConflict(Exception):
+    """
+    Raised when a new influencer violates the unique username or user_id constraint
+    """
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class OnboardingWriter:
+    """
+    Write pipeline for onboarding. Instead of checking uniqueness with SELECTs
+    it relies on the unique constraints of the influencers table, and the
+    inserts of requests arriving within "window" seconds of each other (up to
+    "max_batch") are written by one statement and share a single commit, so
+    throughput grows with concurrency instead of being capped by fsync
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: List[Tuple[dict, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # References to running flushes so they are not garbage collected
+        self.flushes = set()
+
+    async def insert(self, values: dict) -> dict:
+        """
+        Inserts an influencer and returns its columns once the batch it is part
+        of is committed, raises OnboardingConflict on unique violations
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((values, future))
+        if len(self.pending) >= self.max_batch or self.window <= 0:
+            self.flush_soon()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush_soon)
+        return await future
+
+    def flush_soon(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.flush(batch))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    async def flush(self, batch: List[Tuple[dict, asyncio.Future]]) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                if db.bind.dialect.name == 'postgresql':
+                    results = await self.write_returning(db, [values for values, _ in batch])
+                else:
+                    results = await self.write_rows(db, [values for values, _ in batch])
+                await db.commit()
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def write_returning(self, db, rows: List[dict]) -> list:
+        """
+        Writes the batch with one INSERT ... ON CONFLICT DO NOTHING RETURNING, rows
+        missing from the returned ones hit a unique constraint. Other violations
+        (e.g. of the foreign key) fail the whole statement, the batch is then
+        written one row at a time to find the rows at fault
+        """
+        statement = pg_insert(Influencer).values(rows).on_conflict_do_nothing().returning(*SEARCH_COLUMNS)
+        try:
+            inserted = {(row.username, row.user_id): dict(row._mapping) for row in await db.execute(statement)}
+        except IntegrityError:
+            await db.rollback()
+            return await self.write_rows(db, rows)
+
+        # Matching the returned rows back to the requests, each one is handed out once
+        results = [inserted.pop((row['username'], row['user_id']), None) for row in rows]
+
+        conflicts = [row['username'] for row, result in zip(rows, results) if result is None]
+        if conflicts:
+            # Finding out which constraint the conflicting rows hit, only when there are any
+            statement = select(Influencer.username).filter(Influencer.username.in_(conflicts))
+            taken_usernames = set((await db.execute(statement)).scalars().all())
+            results = [
+                result if result is not None else OnboardingConflict(USERNAME_TAKEN if row['username'] in taken_usernames else ALREADY_INFLUENCER)
+                for row, result in zip(rows, results)
+            ]
+        return results
+
+    async def write_rows(self, db, rows: List[dict]) -> list:
+        """
+        Writes the batch one row at a time inside savepoints, for databases
+        without INSERT ... RETURNING support
+        """
+        results = []
+        for row in rows:
+            try:
+                async with db.begin_nested():
+                    result = await db.execute(insert(Influencer).values(**row))
+                results.append(result.inserted_primary_key[0])
+            except IntegrityError as e:
+                results.append(row_error(e))
+
+        ids = [result for result in results if not isinstance(result, Exception)]
+        if ids:
+            statement = select(*SEARCH_COLUMNS).filter(Influencer.id.in_(ids))
+            found = {row.id: dict(row._mapping) for row in await db.execute(statement)}
+            results = [result if isinstance(result, Exception) else found[result] for result in results]
+        return results
+
+
+def row_error(error: IntegrityError) -> Exception:
+    """
+    Turns the violation of a row into the OnboardingConflict of the constraint
+    it hit, other violations are handed to the request of the row as they are
+    """
+    message = str(error.orig).lower()
+    if 'foreign key' in message:
+        return OnboardingConflict(USER_MISSING)
+    # "UNIQUE constraint failed" on SQLite and "violates unique constraint" on PostgreSQL
+    if 'unique' in message:
+        return OnboardingConflict(ALREADY_INFLUENCER if 'user_id' in message else USERNAME_TAKEN)
+    return error
@@ -0,0 +1,270 @@
+"""
+Load and latency benchmark of the API.
+
+Seeds the database configured by DB_URL with users and influencers, drives
+"/search", "/login" and "/onboarding" with concurrent clients and reports
+throughput and p50/p95/p99 latency per endpoint. Results are written as
+JSON so runs of different revisions can be compared.
+
+Usage:
+    python -m benchmarks.run --users 10000 --influencers 100000 --output results.json
+    python -m benchmarks.run --url http://localhost:8000 --skip-seed
+    python -m benchmarks.run --compare before.json after.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import random
+import subprocess
+import time
+
+from typing import Dict, List, Optional
+
+import httpx
+from sqlalchemy import func, insert, select
+
+from app.database import Session
+from app.models import User, Influencer
+from app.utils import hash_password
+
+PASSWORD = 'benchpassword'
+WORDS = ['instagram', 'fashion', 'travel', 'food', 'fitness', 'music', 'tech', 'beauty', 'gaming', 'art', 'photo', 'lifestyle', 'sports', 'pets', 'design']
+INSERT_BATCH_SIZE = 5000
+
+
+def seed(users: int, influencers: int, rng: random.Random) -> None:
+    """
+    Inserts "users" users of which the first "influencers" get an influencer
+    profile, all of them share the password PASSWORD
+    """
+    password = hash_password(PASSWORD)
+    db = Session()
+    try:
+        # Numbering on from users seeded by previous runs
+        start = db.query(func.count(User.id)).filter(User.email.like('bench%@example.com')).scalar()
+        for offset in range(0, users, INSERT_BATCH_SIZE):
+            numbers = range(start + offset, start + min(offset + INSERT_BATCH_SIZE, users))
+            db.execute(insert(User), [{'email': f'bench{number}@example.com', 'password': password} for number in numbers])
+            user_ids = dict(db.execute(select(User.email, User.id).filter(User.email.in_([f'bench{number}@example.com' for number in numbers]))).all())
+            profiles = [
+                {
+                    'user_id': user_ids[f'bench{number}@example.com'],
+                    'username': f'bench_{rng.choice(WORDS)}_{number}',
+                    'follower_count': int(rng.paretovariate(1.2) * 100),
+                    'bio': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 8))) or None
+                }
+                for number in numbers if number - start < influencers
+            ]
+            if profiles:
+                db.execute(insert(Influencer), profiles)
+            db.commit()
+    finally:
+        db.close()
+
+
+def percentile(latencies: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of sorted latencies
+    """
+    if not latencies:
+        return 0.0
+    index = max(0, min(len(latencies) - 1, int(round(percent / 100 * len(latencies))) - 1))
+    return latencies[index]
+
+
+class Scenario:
+    """
+    A benchmarked endpoint, "request" sends one request with the client
+    """
+    name = ''
+
+    async def setup(self, client: httpx.AsyncClient) -> None:
+        pass
+
+    async def request(self, client: httpx.AsyncClient) -> httpx.Response:
+        raise NotImplementedError
+
+
+class SearchScenario(Scenario):
+    name = 'search'
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+
+    async def request(self, client):
+        params = {}
+        if self.rng.random() < 0.7:
+            params['keyword'] = self.rng.choice(WORDS)[:self.rng.randint(3, 6)]
+        if self.rng.random() < 0.5:
+            params['min_followers'] = self.rng.choice([100, 200, 500, 1000])
+        if self.rng.random() < 0.3:
+            params['max_followers'] = self.rng.choice([1000, 5000, 100000])
+        return await client.get('/search', params = params)
+
+
+class LoginScenario(Scenario):
+    name = 'login'
+
+    def __init__(self, rng: random.Random, users: int):
+        self.rng = rng
+        self.users = users
+
+    async def request(self, client):
+        return await client.post('/login', json = {'email': f'bench{self.rng.randrange(self.users)}@example.com', 'password': PASSWORD})
+
+
+class OnboardingScenario(Scenario):
+    """
+    Every request onboards a fresh user, the users are registered and logged
+    in during setup so only "/onboarding" is measured
+    """
+    name = 'onboarding'
+
+    def __init__(self, rng: random.Random, requests: int):
+        self.rng = rng
+        self.requests = requests
+        self.tokens = []
+        self.run = ''
+
+    async def setup(self, client):
+        run = f'{int(time.time())}{self.rng.randrange(10 ** 6)}'
+        for number in range(self.requests):
+            credentials = {'email': f'onboard{run}_{number}@example.com', 'password': PASSWORD}
+            await client.post('/register', json = credentials)
+            self.tokens.append((number, (await client.post('/login', json = credentials)).json()['access_token']))
+        client.cookies.clear()
+        self.run = run
+
+    async def request(self, client):
+        number, token = self.tokens.pop()
+        data = {'username': f'onboard{self.run}_{number}', 'follower_count': self.rng.randint(0, 10000), 'bio': 'benchmark influencer'}
+        return await client.post('/onboarding', json = data, headers = {'Authorization': f'Bearer {token}'})
+
+
+async def drive(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int) -> Dict:
+    """
+    Sends "requests" requests of a scenario from "concurrency" concurrent clients
+    """
+    await scenario.setup(client)
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                response = await scenario.request(client)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(requests / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2)
+    }
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(args) -> Dict:
+    rng = random.Random(args.seed)
+    if not args.skip_seed:
+        seed(args.users, args.influencers, rng)
+
+    scenarios = {
+        'search': SearchScenario(rng),
+        'login': LoginScenario(rng, args.users),
+        'onboarding': OnboardingScenario(rng, args.requests)
+    }
+
+    results = {}
+    async with contextlib.AsyncExitStack() as stack:
+        # Driving a running server when a URL is given, the app in-process otherwise
+        if args.url:
+            client = httpx.AsyncClient(base_url = args.url, timeout = 60)
+        else:
+            from app.main import app
+            from app.ratelimit import login_rate_limit, register_rate_limit
+            # Every request comes from the same client, which the rate limits would treat as an attack
+            for rate_limit in (login_rate_limit, register_rate_limit):
+                app.dependency_overrides[rate_limit] = lambda: None
+            await stack.enter_async_context(app.router.lifespan_context(app))
+            client = httpx.AsyncClient(app = app, base_url = 'http://benchmark', timeout = 60)
+
+        async with client:
+            for name in args.endpoints:
+                results[name] = await drive(client, scenarios[name], args.requests, args.concurrency)
+                print(name, json.dumps(results[name]))
+
+    return {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'users': args.users,
+        'influencers': args.influencers,
+        'results': results
+    }
+
+
+def compare(before_path: str, after_path: str) -> None:
+    """
+    Prints the change of every metric between two result files
+    """
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"{before.get('revision')} -> {after.get('revision')}")
+    for name, metrics in after['results'].items():
+        if name not in before['results']:
+            continue
+        for metric in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = before['results'][name][metric], metrics[metric]
+            change = (new - old) / old * 100 if old else 0.0
+            print(f'{name:<12}{metric:<12}{old:>12}{new:>12}{change:>+10.1f}%')
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description = 'Benchmark the API endpoints')
+    parser.add_argument('--users', type = int, default = 1000, help = 'Users to seed')
+    parser.add_argument('--influencers', type = int, default = 1000, help = 'Seeded users which get an influencer profile')
+    parser.add_argument('--skip-seed', action = 'store_true', help = 'Reuse data seeded by a previous run')
+    parser.add_argument('--requests', type = int, default = 500, help = 'Requests per endpoint')
+    parser.add_argument('--concurrency', type = int, default = 16, help = 'Concurrent clients')
+    parser.add_argument('--endpoints', nargs = '+', default = ['search', 'login', 'onboarding'], choices = ['search', 'login', 'onboarding'])
+    parser.add_argument('--url', help = 'Base URL of a running server, the app is run in-process otherwise')
+    parser.add_argument('--seed', type = int, default = 42, help = 'Random seed so runs are reproducible')
+    parser.add_argument('--output', help = 'File to write the JSON results to')
+    parser.add_argument('--compare', nargs = 2, metavar = ('BEFORE', 'AFTER'), help = 'Compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = asyncio.run(benchmark(args))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent = 2)
+
+
+if __name__ == '__main__':
+    main()